@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# Converts legacy string dates to BSON dates and adds the native
+# day/start_minute fields to reservations. Safe to interrupt and re-run:
+# progress is checkpointed per migration in db.migrations.
+import argparse
+import asyncio
+import logging
+
+import server
+
+async def main(batch_size: int, reset: bool):
+    if reset:
+        await server.db.migrations.delete_many({'_id': {'$in': [m[0] for m in server.DATE_MIGRATIONS]}})
+    await server.run_date_migrations(batch_size)
+    async for checkpoint in server.db.migrations.find({'_id': {'$in': [m[0] for m in server.DATE_MIGRATIONS]}}):
+        logging.info(f"{checkpoint['_id']}: {checkpoint.get('converted', 0)} converted, done={checkpoint.get('done', False)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Migrate reservation and HACCP dates to native types')
+    parser.add_argument('--batch-size', type=int, default=server.DATE_MIGRATION_BATCH)
+    parser.add_argument('--reset', action='store_true', help='forget checkpoints and scan again')
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size, args.reset))
@@ -1,39 +1,159 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Query, Header, Request, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import json_util, ObjectId
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
+import base64
+import hashlib
+import re
+import tempfile
+import io
+import csv
+import json
+import zlib
+import math
+from datetime import datetime, timezone, timedelta, time as dt_time
+from time import monotonic
+from contextvars import ContextVar
 import bcrypt
 import jwt
 import resend
 import asyncio
 from enum import Enum
+from bisect import bisect_left
+from functools import lru_cache
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ImportError:
+    # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Per-request counters (RequestMetrics) for the request being handled, if any
+current_request = ContextVar('current_request', default=None)
+
+class CommandMetrics(monitoring.CommandListener):
+    # Attributes Mongo round trips to the request that issued them. Motor
+    # runs pymongo with a copy of the caller's context, so the request's
+    # counters are visible from the executor thread.
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics = current_request.get()
+        if metrics is None:
+            return
+        metrics.db_calls += 1
+        metrics.db_seconds += event.duration_micros / 1e6
+        cursor = event.reply.get('cursor')
+        if isinstance(cursor, dict):
+            metrics.documents += len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+        elif event.command_name in ('findAndModify', 'count'):
+            metrics.documents += 1
+
+    def failed(self, event):
+        metrics = current_request.get()
+        if metrics is not None:
+            metrics.db_calls += 1
+            metrics.db_seconds += event.duration_micros / 1e6
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[CommandMetrics()])
 db = client[os.environ['DB_NAME']]
 
+# Tenancy
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
+TENANT_CACHE_SIZE = int(os.environ.get('TENANT_CACHE_SIZE', '1024'))
+
 # Resend setup
 resend.api_key = os.environ.get('RESEND_API_KEY', '')
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'onboarding@resend.dev')
+EMAIL_TRANSPORT = os.environ.get('EMAIL_TRANSPORT', 'resend')
+EMAIL_BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE', '50'))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', '6'))
+EMAIL_RETRY_BASE_SECONDS = float(os.environ.get('EMAIL_RETRY_BASE_SECONDS', '30'))
+EMAIL_POLL_SECONDS = float(os.environ.get('EMAIL_POLL_SECONDS', '5'))
+EMAIL_LEASE_SECONDS = 300
 
 # JWT setup
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = 'HS256'
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '1024'))
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', '60'))
+AUTH_REVOCATION_CHECK_SECONDS = float(os.environ.get('AUTH_REVOCATION_CHECK_SECONDS', '1'))
+# Lifetime of the tickets EventSource puts in the /events URL
+STREAM_TICKET_SECONDS = int(os.environ.get('STREAM_TICKET_SECONDS', '60'))
+
+# Password hashing setup
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', '4'))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', '32'))
+
+# JSON responses
+def encode_json(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(jsonable_encoder(content), separators=(',', ':')).encode('utf-8')
+
+class FastJSONResponse(Response):
+    # orjson when installed, the stdlib encoder otherwise. Encoding counts
+    # as the request's "serialize" phase.
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        started = monotonic()
+        try:
+            return encode_json(content)
+        finally:
+            track_phase('serialize', monotonic() - started)
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
@@ -62,6 +182,7 @@ class HACCPType(str, Enum):
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
     user_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     name: str
     email: EmailStr
     role: str = "admin"
@@ -79,6 +200,7 @@ class UserLogin(BaseModel):
 class Room(BaseModel):
     model_config = ConfigDict(extra="ignore")
     room_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     name: str
     capacity: int
 
@@ -89,6 +211,7 @@ class RoomCreate(BaseModel):
 class Table(BaseModel):
     model_config = ConfigDict(extra="ignore")
     table_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     number: str
     room_id: str
     capacity: int
@@ -103,6 +226,7 @@ class TableCreate(BaseModel):
 class Settings(BaseModel):
     model_config = ConfigDict(extra="ignore")
     settings_id: str = "global"
+    tenant_id: str = DEFAULT_TENANT
     open_days: List[int]
     lunch_start: str
     lunch_end: str
@@ -125,6 +249,7 @@ class SettingsUpdate(BaseModel):
 class Reservation(BaseModel):
     model_config = ConfigDict(extra="ignore")
     reservation_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     name: str
     phone: str
     email: Optional[EmailStr] = None
@@ -133,6 +258,8 @@ class Reservation(BaseModel):
     time: str
     meal_type: MealType
     table_id: Optional[str] = None
+    table_ids: List[str] = Field(default_factory=list)
+    duration: Optional[int] = None
     status: ReservationStatus = ReservationStatus.pending
     notes: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -154,18 +281,25 @@ class ReservationUpdate(BaseModel):
     date: Optional[str] = None
     time: Optional[str] = None
     table_id: Optional[str] = None
+    table_ids: Optional[List[str]] = None
     status: Optional[ReservationStatus] = None
     notes: Optional[str] = None
 
 class HACCPRecord(BaseModel):
     model_config = ConfigDict(extra="ignore")
     record_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     record_type: HACCPType
     equipment_product: str
     value: Optional[str] = None
+    numeric_value: Optional[float] = None
     photo_url: Optional[str] = None
+    photo_blob: Optional[str] = None
+    photo_thumbnail: Optional[str] = None
     user_name: str
     signature: Optional[str] = None
+    signature_blob: Optional[str] = None
+    signature_thumbnail: Optional[str] = None
     notes: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -178,9 +312,28 @@ class HACCPRecordCreate(BaseModel):
     signature: Optional[str] = None
     notes: Optional[str] = None
 
+class HACCPRule(BaseModel):
+    # A rule with min_value/max_value flags out-of-range readings; otherwise
+    # it requires min_count records inside the window
+    model_config = ConfigDict(extra="ignore")
+    rule_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    record_type: HACCPType
+    equipment_product: Optional[str] = None
+    min_count: int = 0
+    window_start: str = "00:00"
+    window_end: str = "23:59"
+    min_value: Optional[float] = None
+    max_value: Optional[float] = None
+    priority: str = "medium"
+    message: str
+
+class HACCPRulesUpdate(BaseModel):
+    rules: List[HACCPRule]
+
 class Equipment(BaseModel):
     model_config = ConfigDict(extra="ignore")
     equipment_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     name: str
     type: str
     location: Optional[str] = None
@@ -193,6 +346,7 @@ class EquipmentCreate(BaseModel):
 class Space(BaseModel):
     model_config = ConfigDict(extra="ignore")
     space_id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    tenant_id: str = DEFAULT_TENANT
     name: str
     type: str
 
@@ -207,71 +361,2169 @@ class DashboardStats(BaseModel):
     haccp_alerts: int
     pending_records: int
 
+# Metrics
+class LatencyStats:
+    # Cumulative latency histogram in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bucket_counts = [0] * len(self.buckets)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.bucket_counts[index] += 1
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            'max_ms': round(self.max * 1000, 2),
+            'buckets': {str(bound): n for bound, n in zip(self.buckets, self.bucket_counts)}
+        }
+
+    def prometheus(self, name: str, labels: str) -> List[str]:
+        separator = ',' if labels else ''
+        lines = [
+            f'{name}_bucket{{{labels}{separator}le="{bound}"}} {n}'
+            for bound, n in zip(self.buckets, self.bucket_counts)
+        ]
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class RequestMetrics:
+    # Counters for one request; see current_request
+    __slots__ = ('db_calls', 'db_seconds', 'documents', 'phases')
+
+    def __init__(self):
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.documents = 0
+        self.phases = {}
+
+def track_phase(phase: str, seconds: float):
+    # Adds time spent in e.g. serialization or bcrypt to the current request
+    metrics = current_request.get()
+    if metrics is not None:
+        metrics.phases[phase] = metrics.phases.get(phase, 0.0) + seconds
+
+class RouteStats:
+    def __init__(self):
+        self.latency = LatencyStats()
+        self.statuses = {}
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.documents = 0
+        self.phases = {}
+
+    def observe(self, status_code: int, seconds: float, metrics: RequestMetrics):
+        self.latency.observe(seconds)
+        self.statuses[status_code] = self.statuses.get(status_code, 0) + 1
+        self.db_calls += metrics.db_calls
+        self.db_seconds += metrics.db_seconds
+        self.documents += metrics.documents
+        for phase, phase_seconds in metrics.phases.items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + phase_seconds
+
+route_stats = {}
+
+def route_metrics_lines() -> List[str]:
+    # The exposition format wants all samples of a family together
+    routes = [(f'method="{method}",route="{route}"', stats) for (method, route), stats in sorted(route_stats.items())]
+    lines = ['# TYPE http_request_duration_seconds histogram']
+    for labels, stats in routes:
+        lines.extend(stats.latency.prometheus('http_request_duration_seconds', labels))
+    lines.append('# TYPE http_requests_total counter')
+    for labels, stats in routes:
+        for status_code, count in sorted(stats.statuses.items()):
+            lines.append(f'http_requests_total{{{labels},status="{status_code}"}} {count}')
+    for name, field in (
+        ('mongo_commands_total', 'db_calls'),
+        ('mongo_command_seconds_total', 'db_seconds'),
+        ('mongo_documents_returned_total', 'documents'),
+    ):
+        lines.append(f'# TYPE {name} counter')
+        for labels, stats in routes:
+            lines.append(f'{name}{{{labels}}} {getattr(stats, field)}')
+    lines.append('# TYPE request_phase_seconds_total counter')
+    for labels, stats in routes:
+        for phase, seconds in sorted(stats.phases.items()):
+            lines.append(f'request_phase_seconds_total{{{labels},phase="{phase}"}} {seconds}')
+    return lines
+
 # Auth functions
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_token(user_id: str) -> str:
+class PasswordPool:
+    # Runs bcrypt off the event loop on a bounded thread pool. Once
+    # PASSWORD_QUEUE_LIMIT calls are in flight new ones get a 429 instead
+    # of queueing behind the others.
+    def __init__(self, workers: int, queue_limit: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.rejected = 0
+        self.stats = {'hash': LatencyStats(), 'verify': LatencyStats(), 'total': LatencyStats()}
+
+    def _timed(self, operation: str, func, args):
+        started = monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.stats[operation].observe(monotonic() - started)
+
+    async def run(self, operation: str, func, *args):
+        if self.pending >= self.queue_limit:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many authentication requests, please retry",
+                headers={'Retry-After': '1'}
+            )
+        self.pending += 1
+        started = monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._timed, operation, func, args
+            )
+        finally:
+            self.pending -= 1
+            self.stats['total'].observe(monotonic() - started)
+            track_phase('bcrypt', monotonic() - started)
+
+    def snapshot(self) -> dict:
+        return {
+            'pending': self.pending,
+            'rejected': self.rejected,
+            'rounds': BCRYPT_ROUNDS,
+            **{operation: stats.snapshot() for operation, stats in self.stats.items()}
+        }
+
+password_pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
+
+def create_token(user: dict) -> str:
     payload = {
-        'user_id': user_id,
+        'user_id': user['user_id'],
+        'name': user['name'],
+        'email': user['email'],
+        'role': user['role'],
+        'tenant_id': user.get('tenant_id', DEFAULT_TENANT),
+        'token_version': user.get('token_version', 0),
         'exp': datetime.now(timezone.utc) + timedelta(days=7)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+def create_stream_ticket(principal: dict) -> str:
+    # Short-lived token that only opens GET /events. It travels in the URL,
+    # where access logs record it, so the session token never has to.
+    payload = {
+        'user_id': principal['user_id'],
+        'token_version': principal['token_version'],
+        'scope': 'events',
+        'exp': datetime.now(timezone.utc) + timedelta(seconds=STREAM_TICKET_SECONDS)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+class PrincipalCache:
+    # Bounded LRU of authenticated users keyed by user_id. Entries expire
+    # after AUTH_CACHE_TTL seconds. Revocations on any worker bump a shared
+    # stamp; each worker reads it at most every AUTH_REVOCATION_CHECK_SECONDS
+    # and drops its entries when it moved.
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.revocations = 0
+        self.synced_at = float('-inf')
+
+    async def sync(self):
+        if monotonic() - self.synced_at < AUTH_REVOCATION_CHECK_SECONDS:
+            return
+        self.synced_at = monotonic()
+        stamp = await db.auth_revocations.find_one({'_id': 'sessions'}, {'version': 1})
+        version = stamp['version'] if stamp else 0
+        if version != self.revocations:
+            self.revocations = version
+            self.clear()
+
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        principal, expires_at = entry
+        if monotonic() >= expires_at:
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return principal
+
+    def put(self, principal: dict):
+        self.entries[principal['user_id']] = (principal, monotonic() + self.ttl)
+        self.entries.move_to_end(principal['user_id'])
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def revoke(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+principal_cache = PrincipalCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+async def revoke_user_sessions(user_id: str):
+    # Called after the user was deleted or its token_version bumped; the
+    # next request on any worker re-checks the users collection
+    principal_cache.revoke(user_id)
+    await db.auth_revocations.update_one({'_id': 'sessions'}, {'$inc': {'version': 1}}, upsert=True)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await authenticate_token(credentials.credentials)
+
+async def authenticate_token(token: str, scope: Optional[str] = None) -> dict:
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        # Session tokens carry no scope; a stream ticket is only good for its own
+        if payload.get('scope') != scope:
+            raise HTTPException(status_code=401, detail="Invalid token")
         user_id = payload.get('user_id')
-        user = await db.users.find_one({'user_id': user_id}, {'_id': 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        await principal_cache.sync()
+        principal = principal_cache.get(user_id)
+        if principal is None:
+            principal = await db.users.find_one(
+                {'user_id': user_id},
+                {'_id': 0, 'user_id': 1, 'name': 1, 'email': 1, 'role': 1, 'tenant_id': 1, 'token_version': 1}
+            )
+            if not principal:
+                raise HTTPException(status_code=401, detail="User not found")
+            principal.setdefault('tenant_id', DEFAULT_TENANT)
+            principal.setdefault('token_version', 0)
+            principal_cache.put(principal)
+        # Tokens issued before the user's sessions were revoked
+        if payload.get('token_version', 0) != principal['token_version']:
+            raise HTTPException(status_code=401, detail="Session revoked")
+        return principal
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# Tenants
+async def create_tenant(owner_id: str) -> str:
+    # The first account on a fresh install takes the default tenant, the
+    # one the public booking page uses; every later sign-up gets a new
+    # restaurant. Joining an existing one goes through POST /auth/users.
+    try:
+        claimed = await db.tenants.update_one(
+            {'tenant_id': DEFAULT_TENANT, 'owner_id': None},
+            {'$set': {'owner_id': owner_id}, '$setOnInsert': {'created_at': datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        if claimed.modified_count or claimed.upserted_id is not None:
+            return DEFAULT_TENANT
+    except DuplicateKeyError:
+        pass
+    tenant_id = str(uuid.uuid4())
+    await db.tenants.insert_one({'tenant_id': tenant_id, 'owner_id': owner_id, 'created_at': datetime.now(timezone.utc)})
+    return tenant_id
+
+async def release_tenant(tenant_id: str, owner_id: str):
+    # Undoes create_tenant when the owner's account could not be created
+    if tenant_id == DEFAULT_TENANT:
+        await db.tenants.update_one({'tenant_id': tenant_id, 'owner_id': owner_id}, {'$set': {'owner_id': None}})
+    else:
+        await db.tenants.delete_one({'tenant_id': tenant_id, 'owner_id': owner_id})
+
+async def register_tenants():
+    # Tenants created before the registry existed are owned by one of their
+    # users; the default tenant always exists so the booking page works
+    # before anyone has signed up
+    for tenant_id in await db.users.distinct('tenant_id'):
+        user = await db.users.find_one({'tenant_id': tenant_id}, {'_id': 0, 'user_id': 1})
+        try:
+            await db.tenants.update_one(
+                {'tenant_id': tenant_id},
+                {'$setOnInsert': {'owner_id': user['user_id'], 'created_at': datetime.now(timezone.utc)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass
+        await db.tenants.update_one({'tenant_id': tenant_id, 'owner_id': None}, {'$set': {'owner_id': user['user_id']}})
+    try:
+        await db.tenants.update_one(
+            {'tenant_id': DEFAULT_TENANT},
+            {'$setOnInsert': {'owner_id': None, 'created_at': datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass
+
+class TenantRegistry:
+    # Bounded LRU of tenant ids known to exist. Unknown ids are looked up
+    # every time and never cached, so made-up ids cannot grow it.
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.known = OrderedDict()
+
+    async def exists(self, tenant_id: str) -> bool:
+        if tenant_id in self.known:
+            self.known.move_to_end(tenant_id)
+            return True
+        if not await db.tenants.find_one({'tenant_id': tenant_id}, {'_id': 1}):
+            return False
+        self.known[tenant_id] = True
+        while len(self.known) > self.maxsize:
+            self.known.popitem(last=False)
+        return True
+
+tenant_registry = TenantRegistry(TENANT_CACHE_SIZE)
+
+async def get_tenant_id(x_tenant_id: Optional[str] = Header(None), tenant: Optional[str] = None) -> str:
+    # Public booking routes pick the restaurant from the X-Tenant-ID header
+    # or ?tenant=; admin routes use the tenant of the logged-in user
+    tenant_id = x_tenant_id or tenant or DEFAULT_TENANT
+    if not await tenant_registry.exists(tenant_id):
+        raise HTTPException(status_code=404, detail="Restaurant not found")
+    return tenant_id
+
 # Email functions
-async def send_email(to: str, subject: str, html: str):
-    if not resend.api_key or resend.api_key == '':
-        logger.warning("Resend API key not configured, skipping email")
+class ResendTransport:
+    async def send_batch(self, messages: List[dict]):
+        params = [
+            {"from": SENDER_EMAIL, "to": [m['to']], "subject": m['subject'], "html": m['html']}
+            for m in messages
+        ]
+        await asyncio.to_thread(resend.Batch.send, params)
+
+class FakeEmailTransport:
+    # Offline stand-in for Resend that records what would have been sent
+    def __init__(self):
+        self.sent: List[dict] = []
+        self.fail_next = 0
+        self.rejected_recipients = set()
+
+    async def send_batch(self, messages: List[dict]):
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise RuntimeError("Fake transport failure")
+        rejected = [m['to'] for m in messages if m['to'] in self.rejected_recipients]
+        if rejected:
+            raise RuntimeError(f"Fake transport rejected {', '.join(rejected)}")
+        self.sent.extend(messages)
+
+def create_email_transport():
+    if EMAIL_TRANSPORT == 'fake':
+        return FakeEmailTransport()
+    if not resend.api_key:
+        logger.warning("Resend API key not configured, emails will not be sent")
+        return None
+    return ResendTransport()
+
+email_transport = create_email_transport()
+
+async def send_email(to: str, subject: str, html: str, idempotency_key: Optional[str] = None):
+    # Queues the email in the outbox; the outbox worker delivers it
+    if not email_transport:
+        return None
+    started = monotonic()
+    try:
+        return await enqueue_email(to, subject, html, idempotency_key)
+    finally:
+        track_phase('send_email', monotonic() - started)
+
+async def enqueue_email(to: str, subject: str, html: str, idempotency_key: Optional[str]):
+    message = {
+        'message_id': str(uuid.uuid4()),
+        'idempotency_key': idempotency_key or str(uuid.uuid4()),
+        'to': to,
+        'subject': subject,
+        'html': html,
+        'status': 'pending',
+        'attempts': 0,
+        'next_attempt_at': datetime.now(timezone.utc),
+        'last_error': None,
+        'created_at': datetime.now(timezone.utc)
+    }
+    try:
+        await db.email_outbox.insert_one(message)
+    except DuplicateKeyError:
+        return None
+    email_outbox.wake()
+    return message['message_id']
+
+class EmailOutbox:
+    # Drains email_outbox in batches. Messages are leased one by one with
+    # find_one_and_update so several workers can share the outbox. A failed
+    # batch is sent again message by message, so one bad recipient does not
+    # hold back the rest; failed messages are retried with exponential backoff.
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def wake(self):
+        self.event.set()
+
+    def start(self):
+        if email_transport and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                while await self.drain_batch():
+                    pass
+            except Exception as e:
+                logger.error(f"Email outbox error: {str(e)}")
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout=EMAIL_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.event.clear()
+
+    async def lease_batch(self) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        batch = []
+        for _ in range(EMAIL_BATCH_SIZE):
+            message = await db.email_outbox.find_one_and_update(
+                {'$or': [
+                    {'status': 'pending', 'next_attempt_at': {'$lte': now}},
+                    {'status': 'sending', 'leased_until': {'$lte': now}}
+                ]},
+                {'$set': {'status': 'sending', 'leased_until': now + timedelta(seconds=EMAIL_LEASE_SECONDS)}},
+                projection={'_id': 0},
+                sort=[('next_attempt_at', 1)]
+            )
+            if not message:
+                break
+            batch.append(message)
+        return batch
+
+    async def drain_batch(self) -> bool:
+        batch = await self.lease_batch()
+        if not batch:
+            return False
+        sent = batch
+        try:
+            await email_transport.send_batch(batch)
+        except Exception as e:
+            logger.error(f"Failed to send email batch: {str(e)}")
+            if len(batch) == 1:
+                await self.reschedule(batch[0], str(e))
+                return False
+            sent = []
+            for message in batch:
+                try:
+                    await email_transport.send_batch([message])
+                    sent.append(message)
+                except Exception as e:
+                    await self.reschedule(message, str(e))
+        if sent:
+            await db.email_outbox.update_many(
+                {'message_id': {'$in': [m['message_id'] for m in sent]}},
+                {'$set': {'status': 'sent', 'sent_at': datetime.now(timezone.utc)}}
+            )
+        return len(sent) == EMAIL_BATCH_SIZE
+
+    async def reschedule(self, message: dict, error: str):
+        attempts = message['attempts'] + 1
+        update = {'attempts': attempts, 'last_error': error}
+        if attempts >= EMAIL_MAX_ATTEMPTS:
+            update['status'] = 'failed'
+        else:
+            update['status'] = 'pending'
+            delay = EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+            update['next_attempt_at'] = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        await db.email_outbox.update_one({'message_id': message['message_id']}, {'$set': update})
+
+email_outbox = EmailOutbox()
+
+# Change feed
+EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', '1000'))
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', '256'))
+EVENT_KEEPALIVE_SECONDS = 15
+
+class Subscription:
+    def __init__(self, tenant_id: str):
+        self.tenant_id = tenant_id
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.overflowed = False
+
+class ChangeFeed:
+    # In-process fan-out of reservation and HACCP deltas to admin screens.
+    # Event ids carry a per-process boot id and a sequence number; the last
+    # EVENT_BUFFER_SIZE events are kept so reconnecting clients can resume.
+    def __init__(self):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.sequence = 0
+        self.buffer = deque(maxlen=EVENT_BUFFER_SIZE)
+        self.subscriptions = set()
+
+    def current_id(self) -> str:
+        return f'{self.boot_id}-{self.sequence}'
+
+    def publish(self, event_type: str, data: dict):
+        # Sequence numbers are shared across tenants; each subscriber only
+        # sees its own tenant's events
+        self.sequence += 1
+        tenant_id = data.get('tenant_id', DEFAULT_TENANT)
+        event = (self.current_id(), event_type, json.dumps(jsonable_encoder(data)))
+        self.buffer.append((self.sequence, tenant_id, event))
+        # Subscribers refetch the dashboard on every event
+        dashboard_cache.invalidate(lambda key: key[0] == tenant_id)
+        for subscription in self.subscriptions:
+            if subscription.overflowed or subscription.tenant_id != tenant_id:
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow consumer: drop its backlog, it will be told to reload
+                subscription.overflowed = True
+
+    def subscribe(self, tenant_id: str) -> Subscription:
+        subscription = Subscription(tenant_id)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def replay(self, last_event_id: str, tenant_id: str) -> Optional[list]:
+        # Events after last_event_id, or None if it can no longer be resumed
+        boot_id, _, sequence = last_event_id.rpartition('-')
+        if boot_id != self.boot_id or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        if sequence > self.sequence:
+            return None
+        if sequence < self.sequence and (not self.buffer or self.buffer[0][0] > sequence + 1):
+            return None
+        return [
+            event for event_sequence, event_tenant, event in self.buffer
+            if event_sequence > sequence and event_tenant == tenant_id
+        ]
+
+change_feed = ChangeFeed()
+
+def format_event(event_id: str, event_type: str, data: str) -> str:
+    return f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+
+async def event_stream(request: Request, subscription: Subscription, backlog: Optional[list]):
+    try:
+        if backlog is None:
+            yield format_event(change_feed.current_id(), 'reset', '{}')
+        else:
+            for event in backlog:
+                yield format_event(*event)
+        while not await request.is_disconnected():
+            if subscription.overflowed:
+                while not subscription.queue.empty():
+                    subscription.queue.get_nowait()
+                subscription.overflowed = False
+                yield format_event(change_feed.current_id(), 'reset', '{}')
+                continue
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            yield format_event(*event)
+    finally:
+        change_feed.unsubscribe(subscription)
+
+# Settings cache
+SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', '5'))
+SETTINGS_CACHE_SIZE = int(os.environ.get('SETTINGS_CACHE_SIZE', '1024'))
+
+def parse_time(value: str) -> dt_time:
+    return datetime.strptime(value, "%H:%M").time()
+
+class SettingsSnapshot:
+    # Settings document with the service hours parsed once
+    def __init__(self, settings: dict):
+        self.data = settings
+        self.version = settings.get('version', 0)
+        self.open_days = frozenset(settings['open_days'])
+        self.lunch_start = parse_time(settings['lunch_start'])
+        self.lunch_end = parse_time(settings['lunch_end'])
+        self.dinner_start = parse_time(settings['dinner_start'])
+        self.dinner_end = parse_time(settings['dinner_end'])
+        self.avg_table_time = settings['avg_table_time']
+
+    def service_for(self, time_obj: dt_time):
+        # Returns (meal_type, max_capacity) or None outside service hours
+        if self.lunch_start <= time_obj <= self.lunch_end:
+            return MealType.lunch, self.data['max_capacity_lunch']
+        if self.dinner_start <= time_obj <= self.dinner_end:
+            return MealType.dinner, self.data['max_capacity_dinner']
+        return None
+
+class SettingsCache:
+    # Keeps the parsed settings in process. update_settings bumps a version
+    # stamp on the document; other workers notice it when they revalidate
+    # after SETTINGS_CACHE_TTL seconds by reading only that stamp.
+    def __init__(self, tenant_id: str):
+        self.tenant_id = tenant_id
+        self.snapshot: Optional[SettingsSnapshot] = None
+        self.checked_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def get(self) -> Optional[SettingsSnapshot]:
+        if self.snapshot and monotonic() - self.checked_at < SETTINGS_CACHE_TTL:
+            return self.snapshot
+        async with self.lock:
+            if self.snapshot and monotonic() - self.checked_at < SETTINGS_CACHE_TTL:
+                return self.snapshot
+            if self.snapshot:
+                stamp = await db.settings.find_one({'tenant_id': self.tenant_id}, {'_id': 0, 'version': 1})
+                if stamp is not None and stamp.get('version', 0) == self.snapshot.version:
+                    self.checked_at = monotonic()
+                    return self.snapshot
+            settings = await db.settings.find_one({'tenant_id': self.tenant_id}, {'_id': 0})
+            self.snapshot = SettingsSnapshot(settings) if settings else None
+            self.checked_at = monotonic()
+            return self.snapshot
+
+    def invalidate(self):
+        self.snapshot = None
+
+# Least recently used tenants are dropped past SETTINGS_CACHE_SIZE
+settings_caches = OrderedDict()
+
+def tenant_settings(tenant_id: str) -> SettingsCache:
+    if tenant_id in settings_caches:
+        settings_caches.move_to_end(tenant_id)
+        return settings_caches[tenant_id]
+    settings_caches[tenant_id] = SettingsCache(tenant_id)
+    while len(settings_caches) > SETTINGS_CACHE_SIZE:
+        settings_caches.popitem(last=False)
+    return settings_caches[tenant_id]
+
+# Result cache
+DASHBOARD_CACHE_TTL = float(os.environ.get('DASHBOARD_CACHE_TTL', '5'))
+
+class ResultCache:
+    # Short-lived cache of computed results. Concurrent misses for the same
+    # key wait on one computation instead of each querying the database.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries = {}
+        self.locks = {}
+        self.generation = 0
+
+    async def get_or_compute(self, key, compute):
+        entry = self.entries.get(key)
+        if entry and monotonic() < entry[1]:
+            return entry[0]
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(key)
+            if entry and monotonic() < entry[1]:
+                return entry[0]
+            generation = self.generation
+            value = await compute()
+            # Drop expired entries so old keys (e.g. past days) do not pile up
+            now = monotonic()
+            self.entries = {k: e for k, e in self.entries.items() if e[1] > now}
+            # A result computed across an invalidation may predate the change
+            if generation == self.generation:
+                self.entries[key] = (value, now + self.ttl)
+            return value
+
+    def invalidate(self, match=None):
+        # Drops the entries whose key satisfies match, or all of them
+        self.generation += 1
+        self.entries = {k: e for k, e in self.entries.items() if match is not None and not match(k)}
+
+dashboard_cache = ResultCache(DASHBOARD_CACHE_TTL)
+
+# Reference data versions
+REFERENCE_VERSION_TTL = float(os.environ.get('REFERENCE_VERSION_TTL', '5'))
+
+class ReferenceVersions:
+    # Per-tenant version counter of each reference collection (rooms,
+    # tables, equipment, spaces), bumped by every write route. Versions are
+    # served from memory so a revalidation costs no query; bumps made by
+    # other workers are seen after REFERENCE_VERSION_TTL seconds.
+    def __init__(self):
+        self.versions = {}
+
+    async def get(self, tenant_id: str, collection: str) -> int:
+        key = (tenant_id, collection)
+        cached = self.versions.get(key)
+        if cached and monotonic() - cached[1] < REFERENCE_VERSION_TTL:
+            return cached[0]
+        counter = await db.reference_versions.find_one(
+            {'tenant_id': tenant_id, 'collection': collection},
+            {'_id': 0, 'version': 1}
+        )
+        version = counter['version'] if counter else 0
+        self.versions[key] = (version, monotonic())
+        return version
+
+    async def bump(self, tenant_id: str, collection: str):
+        counter = await db.reference_versions.find_one_and_update(
+            {'tenant_id': tenant_id, 'collection': collection},
+            {'$inc': {'version': 1}},
+            projection={'_id': 0, 'version': 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.versions[(tenant_id, collection)] = (counter['version'], monotonic())
+
+reference_versions = ReferenceVersions()
+
+def reference_etag(request: Request, name: str, tenant_id: str, version: int) -> str:
+    # Strong validator for one representation: paging parameters get
+    # their own tag
+    variant = hashlib.sha1(str(request.query_params).encode('utf-8')).hexdigest()[:8]
+    return f'"{name}-{tenant_id}-{version}-{variant}"'
+
+def reference_headers(etag: str) -> dict:
+    return {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'Authorization, X-Tenant-ID'}
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=reference_headers(etag))
+    return None
+
+async def reference_page(request: Request, collection, name: str, tenant_id: str, model,
+                         limit: int, cursor: Optional[str], stream: bool) -> Response:
+    etag = reference_etag(request, name, tenant_id, await reference_versions.get(tenant_id, name))
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    page = await list_page(collection, {'tenant_id': tenant_id}, INSERTION_ORDER, model, limit, cursor, stream)
+    page.headers.update(reference_headers(etag))
+    return page
+
+# Table allocation
+MAX_JOINED_TABLES = int(os.environ.get('MAX_JOINED_TABLES', '4'))
+TABLE_LAYOUT_CACHE_SIZE = int(os.environ.get('TABLE_LAYOUT_CACHE_SIZE', '1024'))
+
+def time_to_minutes(value: str) -> int:
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def reservation_schedule(date: str, time: str) -> dict:
+    # Native copies of a reservation's date and time strings, used by
+    # range queries; the strings stay the API format and counter keys.
+    # Raises ValueError for a date or time that does not exist.
+    moment = parse_time(time)
+    return {'day': datetime.strptime(date, "%Y-%m-%d"), 'start_minute': moment.hour * 60 + moment.minute}
+
+def table_number_key(table: dict):
+    # Natural order so that table "10" comes after table "9"
+    number = str(table['number'])
+    return (0, int(number), number) if number.isdigit() else (1, 0, number)
+
+@lru_cache(maxsize=256)
+def joinable_combinations(room_tables: tuple) -> tuple:
+    # room_tables holds (table_id, capacity) of one run of joinable tables
+    # in number order; neighbours in that order are treated as adjacent.
+    # Returns every run of 2..MAX_JOINED_TABLES adjacent tables as
+    # (size, capacity, table_ids), smallest first.
+    combinations = []
+    for first in range(len(room_tables)):
+        capacity = room_tables[first][1]
+        for last in range(first + 1, min(first + MAX_JOINED_TABLES, len(room_tables))):
+            capacity += room_tables[last][1]
+            table_ids = tuple(table_id for table_id, _ in room_tables[first:last + 1])
+            combinations.append((len(table_ids), capacity, table_ids))
+    return tuple(sorted(combinations))
+
+class TableSchedule:
+    # Booked intervals of a single table, kept sorted by start minute.
+    # Intervals on one table never overlap, so ends are sorted as well.
+    def __init__(self):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+
+    def is_free(self, start: int, end: int) -> bool:
+        # Only the last interval starting before `end` can overlap [start, end)
+        index = bisect_left(self.starts, end)
+        return index == 0 or self.ends[index - 1] <= start
+
+    def add(self, start: int, end: int):
+        index = bisect_left(self.starts, start)
+        self.starts.insert(index, start)
+        self.ends.insert(index, end)
+
+class TableLayout:
+    # A tenant's tables ordered by capacity, so the smallest table that
+    # fits a party is found by bisection, plus the joinable combinations
+    # of every room. Built once per version of the tenant's tables.
+    def __init__(self, tables: List[dict], version: int):
+        self.version = version
+        self.tables = sorted(tables, key=lambda t: (t['capacity'], t['number']))
+        self.capacities = [t['capacity'] for t in self.tables]
+        
+        # Runs of joinable tables per room, in number order; a table that
+        # cannot be joined sits between its neighbours and ends the run
+        runs = {}
+        for table in sorted(tables, key=table_number_key):
+            room_runs = runs.setdefault(table['room_id'], [[]])
+            if table.get('can_join'):
+                room_runs[-1].append((table['table_id'], table['capacity']))
+            elif room_runs[-1]:
+                room_runs.append([])
+        self.combinations = sorted(
+            combination
+            for room_runs in runs.values()
+            for run in room_runs
+            for combination in joinable_combinations(tuple(run))
+        )
+
+    def candidates(self, guests: int) -> List[str]:
+        # Tables that can seat the party alone or as part of a combination
+        table_ids = {t['table_id'] for t in self.tables[bisect_left(self.capacities, guests):]}
+        for _, capacity, combination in self.combinations:
+            if capacity >= guests:
+                table_ids.update(combination)
+        return list(table_ids)
+
+# Least recently used tenants are dropped past TABLE_LAYOUT_CACHE_SIZE
+table_layouts = OrderedDict()
+
+async def table_layout(tenant_id: str) -> TableLayout:
+    version = await reference_versions.get(tenant_id, 'tables')
+    layout = table_layouts.get(tenant_id)
+    if layout is None or layout.version != version:
+        tables = await db.tables.find({'tenant_id': tenant_id}, {'_id': 0}).to_list(None)
+        layout = TableLayout(tables, version)
+    table_layouts[tenant_id] = layout
+    table_layouts.move_to_end(tenant_id)
+    while len(table_layouts) > TABLE_LAYOUT_CACHE_SIZE:
+        table_layouts.popitem(last=False)
+    return layout
+
+class TableAllocator:
+    # Best-fit allocation over a TableLayout. Schedules only hold the
+    # intervals loaded for this allocation, see claimed_intervals.
+    def __init__(self, layout: TableLayout):
+        self.tables = layout.tables
+        self.capacities = layout.capacities
+        self.combinations = layout.combinations
+        self.schedules = defaultdict(TableSchedule)
+
+    def add(self, table_ids: List[str], start: int, end: int):
+        for table_id in table_ids:
+            self.schedules[table_id].add(start, end)
+
+    def find_table(self, guests: int, start: int, end: int) -> Optional[str]:
+        for table in self.tables[bisect_left(self.capacities, guests):]:
+            if self.schedules[table['table_id']].is_free(start, end):
+                return table['table_id']
         return None
+
+    def find_combination(self, guests: int, start: int, end: int) -> List[str]:
+        # Fewest tables first, then the smallest combined capacity
+        for _, capacity, table_ids in self.combinations:
+            if capacity >= guests and all(self.schedules[t].is_free(start, end) for t in table_ids):
+                return list(table_ids)
+        return []
+
+    def allocate(self, guests: int, start: int, end: int) -> List[str]:
+        table_id = self.find_table(guests, start, end)
+        if table_id:
+            return [table_id]
+        return self.find_combination(guests, start, end)
+
+# Booking consistency
+SLOT_MINUTES = 15
+CLAIM_ATTEMPTS = 3
+
+def interval_slots(start: int, end: int) -> range:
+    # Indexes of the SLOT_MINUTES slots touched by [start, end)
+    return range(start // SLOT_MINUTES, (end - 1) // SLOT_MINUTES + 1)
+
+async def ensure_service_counter(tenant_id: str, date: str, meal_type: str):
+    # Seed the counter from existing reservations the first time a service is booked
+    service = {'tenant_id': tenant_id, 'date': date, 'meal_type': meal_type}
+    if await db.service_capacity.find_one(service, {'_id': 1}):
+        return
+    totals = await db.reservations.aggregate([
+        {'$match': {**service, 'status': {'$ne': 'cancelled'}}},
+        {'$group': {'_id': None, 'guests': {'$sum': '$guests'}}}
+    ]).to_list(1)
+    try:
+        await db.service_capacity.insert_one({
+            **service,
+            'guests': totals[0]['guests'] if totals else 0
+        })
+    except DuplicateKeyError:
+        pass
+
+async def reserve_capacity(tenant_id: str, date: str, meal_type: str, guests: int, max_capacity: int) -> bool:
+    await ensure_service_counter(tenant_id, date, meal_type)
+    counter = await db.service_capacity.find_one_and_update(
+        {'tenant_id': tenant_id, 'date': date, 'meal_type': meal_type, 'guests': {'$lte': max_capacity - guests}},
+        {'$inc': {'guests': guests}},
+        return_document=ReturnDocument.AFTER
+    )
+    return counter is not None
+
+async def adjust_capacity(tenant_id: str, date: str, meal_type: str, guests: int):
+    # Called after the reservation itself was written, so a missing counter
+    # seeded from current state already includes the change
+    result = await db.service_capacity.update_one(
+        {'tenant_id': tenant_id, 'date': date, 'meal_type': meal_type},
+        {'$inc': {'guests': guests}}
+    )
+    if result.matched_count == 0:
+        await ensure_service_counter(tenant_id, date, meal_type)
+
+def table_claim_documents(reservation_id: str, date: str, table_ids: List[str], start: int, end: int) -> List[dict]:
+    # One claim per table and slot touched by [start, end), carrying the
+    # exact interval. Slots the interval covers completely are "full" and
+    # the unique index on full claims rejects a second booking there. The
+    # partly covered slots at either end can be shared by back-to-back
+    # bookings (19:10-20:40 and 20:40-22:10), so claim_conflicts compares
+    # intervals instead. Full claims go first, so a booking that loses one
+    # never writes its partial claims.
+    full, partial = [], []
+    for slot in interval_slots(start, end):
+        covered = start <= slot * SLOT_MINUTES and (slot + 1) * SLOT_MINUTES <= end
+        for table_id in table_ids:
+            (full if covered else partial).append({
+                '_id': ObjectId(),
+                'table_id': table_id,
+                'date': date,
+                'slot': slot,
+                'full': covered,
+                'start': start,
+                'end': end,
+                'reservation_id': reservation_id
+            })
+    return full + partial
+
+async def claimed_intervals(query: dict) -> List[tuple]:
+    # (date, table_ids, start, end) of every reservation with claims
+    # matching query
+    intervals = {}
+    async for claim in db.table_claims.find(
+        query, {'_id': 0, 'table_id': 1, 'date': 1, 'start': 1, 'end': 1, 'reservation_id': 1}
+    ):
+        key = (claim['reservation_id'], claim['date'], claim['start'], claim['end'])
+        intervals.setdefault(key, set()).add(claim['table_id'])
+    return [(date, list(table_ids), start, end) for (_, date, start, end), table_ids in intervals.items()]
+
+async def claim_conflicts(claims: List[dict]) -> set:
+    # Reservation ids among `claims` whose interval overlaps a claim of
+    # another reservation in the same table slot. Runs after the claims
+    # are written, so of two overlapping bookings at least the later one
+    # sees the other.
+    ours = list({claim['reservation_id'] for claim in claims})
+    scopes = {}
+    for claim in claims:
+        tables, slots = scopes.setdefault(claim['date'], (set(), set()))
+        tables.add(claim['table_id'])
+        slots.add(claim['slot'])
+    others = {}
+    for date, (tables, slots) in scopes.items():
+        async for other in db.table_claims.find(
+            {'table_id': {'$in': list(tables)}, 'date': date, 'slot': {'$in': list(slots)}, 'reservation_id': {'$nin': ours}},
+            {'_id': 0, 'table_id': 1, 'slot': 1, 'start': 1, 'end': 1}
+        ):
+            others.setdefault((other['table_id'], date, other['slot']), []).append(other)
+    return {
+        claim['reservation_id']
+        for claim in claims
+        for other in others.get((claim['table_id'], claim['date'], claim['slot']), [])
+        if other['start'] < claim['end'] and claim['start'] < other['end']
+    }
+
+async def claim_tables(reservation_id: str, date: str, table_ids: List[str], start: int, end: int) -> bool:
+    claims = table_claim_documents(reservation_id, date, table_ids, start, end)
+    if not claims:
+        return True
+    try:
+        await db.table_claims.insert_many(claims, ordered=True)
+        if not await claim_conflicts(claims):
+            return True
+    except (BulkWriteError, DuplicateKeyError):
+        pass
+    await release_claims(claims)
+    return False
+
+async def release_tables(reservation_id: str):
+    await db.table_claims.delete_many({'reservation_id': reservation_id})
+
+async def release_claims(claims: List[dict]):
+    # Deletes exactly these claim documents, never ones written by another request
+    if claims:
+        await db.table_claims.delete_many({'_id': {'$in': [claim['_id'] for claim in claims]}})
+
+# Rate limiting
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+# Reverse proxies in front of the app that append to X-Forwarded-For;
+# 0 ignores the header
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '0'))
+# (burst, refill per minute) for public booking attempts
+BOOKING_IP_LIMIT = (
+    int(os.environ.get('BOOKING_IP_BURST', '10')),
+    float(os.environ.get('BOOKING_IP_PER_MINUTE', '10'))
+)
+BOOKING_CONTACT_LIMIT = (
+    int(os.environ.get('BOOKING_CONTACT_BURST', '3')),
+    float(os.environ.get('BOOKING_CONTACT_PER_MINUTE', '1'))
+)
+
+class MemoryRateLimitBackend:
+    # Token buckets in process memory, least recently used evicted first.
+    # Each worker counts on its own; use the redis backend to share them.
+    def __init__(self, max_keys: int):
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+
+    async def take(self, key: str, burst: int, rate: float) -> float:
+        # Takes one token; returns 0 if allowed, else seconds until one is free
+        now = monotonic()
+        tokens, updated = self.buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return wait
+
+# Same algorithm as MemoryRateLimitBackend.take, atomic on the Redis side
+# and timed by the Redis clock so workers agree
+REDIS_TAKE_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+class RedisRateLimitBackend:
+    def __init__(self, url: str):
+        self.client = redis_asyncio.from_url(url)
+        self.script = self.client.register_script(REDIS_TAKE_SCRIPT)
+
+    async def take(self, key: str, burst: int, rate: float) -> float:
+        return float(await self.script(keys=[f'ratelimit:{key}'], args=[burst, rate]))
+
+def create_rate_limit_backend():
+    if RATE_LIMIT_BACKEND == 'redis':
+        if redis_asyncio is None:
+            logger.warning("redis package not installed, rate limits are per worker")
+        else:
+            return RedisRateLimitBackend(REDIS_URL)
+    return MemoryRateLimitBackend(RATE_LIMIT_MAX_KEYS)
+
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.allowed = {}
+        self.rejected = {}
+
+    async def check(self, name: str, key: str, limit: tuple):
+        # Raises 429 once the bucket for (name, key) is empty
+        burst, per_minute = limit
+        try:
+            wait = await self.backend.take(f'{name}:{key}', burst, per_minute / 60)
+        except Exception as e:
+            # A limiter outage must not take bookings down with it
+            logger.error(f"Rate limiter error: {str(e)}")
+            return
+        if wait > 0:
+            self.rejected[name] = self.rejected.get(name, 0) + 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many reservation attempts, please retry later",
+                headers={'Retry-After': str(math.ceil(wait))}
+            )
+        self.allowed[name] = self.allowed.get(name, 0) + 1
+
+    def metrics_lines(self) -> List[str]:
+        lines = ['# TYPE rate_limit_requests_total counter']
+        for name in sorted(self.allowed.keys() | self.rejected.keys()):
+            lines.append(f'rate_limit_requests_total{{limiter="{name}",outcome="allowed"}} {self.allowed.get(name, 0)}')
+            lines.append(f'rate_limit_requests_total{{limiter="{name}",outcome="rejected"}} {self.rejected.get(name, 0)}')
+        return lines
+
+rate_limiter = RateLimiter(create_rate_limit_backend())
+
+def client_ip(request: Request) -> str:
+    if TRUSTED_PROXY_COUNT:
+        # Entries left of the ones our proxies appended come from the client
+        hops = [hop.strip() for hop in request.headers.get('x-forwarded-for', '').split(',') if hop.strip()]
+        if hops:
+            return hops[max(len(hops) - TRUSTED_PROXY_COUNT, 0)]
+    return request.client.host if request.client else 'unknown'
+
+async def limit_booking_ip(request: Request):
+    # Route dependency of create_reservation, solved before get_tenant_id,
+    # so a flood is rejected before any database work, even one naming
+    # made-up tenants
+    await rate_limiter.check('booking_ip', client_ip(request), BOOKING_IP_LIMIT)
+
+async def limit_booking_attempts(reservation_data: ReservationCreate):
+    phone = re.sub(r'\D', '', reservation_data.phone)
+    if phone:
+        await rate_limiter.check('booking_phone', phone, BOOKING_CONTACT_LIMIT)
+    if reservation_data.email:
+        await rate_limiter.check('booking_email', reservation_data.email.lower(), BOOKING_CONTACT_LIMIT)
+
+# Reservation rules
+def resolve_service(date: str, time: str, settings: SettingsSnapshot):
+    # Applies the opening-day and service-hour rules and returns
+    # (meal_type, max_capacity); raises ValueError on malformed input
+    reservation_date = datetime.strptime(date, "%Y-%m-%d")
+    
+    # Check if day is open (Monday=0, Sunday=6)
+    if reservation_date.weekday() not in settings.open_days:
+        raise HTTPException(status_code=400, detail="Restaurant closed on this day")
     
+    # Determine meal type
+    service = settings.service_for(parse_time(time))
+    if not service:
+        raise HTTPException(status_code=400, detail="Time not available for reservations")
+    return service
+
+# Availability
+AVAILABILITY_MAX_DAYS = 62
+
+def availability_increments(reservation: dict, default_duration: int, sign: int) -> dict:
+    # $inc fields adding (sign=1) or removing (sign=-1) a reservation from
+    # its month's availability document
+    guests = sign * reservation.get('guests', 0)
+    prefix = f"services.{reservation['date']}.{MealType(reservation['meal_type']).value}"
+    start = time_to_minutes(reservation['time'])
+    end = start + (reservation.get('duration') or default_duration)
+    increments = {f'{prefix}.guests': guests}
+    for slot in interval_slots(start, end):
+        increments[f'{prefix}.seated.{slot * SLOT_MINUTES}'] = guests
+    return increments
+
+async def rebuild_availability(tenant_id: str, month: str, default_duration: int):
+    # Builds a month document from scratch; used the first time a month is touched
+    document = {'tenant_id': tenant_id, 'month': month, 'services': {}}
+    first_day = datetime.strptime(month, "%Y-%m")
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    reservations = db.reservations.find(
+        {'tenant_id': tenant_id, 'day': {'$gte': first_day, '$lt': next_month}, 'status': {'$ne': 'cancelled'}},
+        {'_id': 0, 'date': 1, 'meal_type': 1, 'time': 1, 'guests': 1, 'duration': 1}
+    )
+    async for reservation in reservations:
+        for path, guests in availability_increments(reservation, default_duration, 1).items():
+            node = document
+            *parents, leaf = path.split('.')
+            for key in parents:
+                node = node.setdefault(key, {})
+            node[leaf] = node.get(leaf, 0) + guests
     try:
-        params = {
-            "from": SENDER_EMAIL,
-            "to": [to],
-            "subject": subject,
-            "html": html
+        await db.availability.insert_one(document)
+    except DuplicateKeyError:
+        pass
+
+async def ensure_availability_month(tenant_id: str, month: str, default_duration: int):
+    # Seed the month before a reservation in it is written, as
+    # ensure_service_counter does for counters. A rebuild that raced the
+    # write then cannot count it as well as its $inc.
+    if await db.availability.find_one({'tenant_id': tenant_id, 'month': month}, {'_id': 1}):
+        return
+    await rebuild_availability(tenant_id, month, default_duration)
+
+async def apply_availability_increments(tenant_id: str, month: str, increments: dict, default_duration: int):
+    # Called after the reservations were written. The month was seeded
+    # before, so a miss means it was removed since and a rebuild already
+    # reflects the change.
+    result = await db.availability.update_one(
+        {'tenant_id': tenant_id, 'month': month},
+        {'$inc': increments}
+    )
+    if result.matched_count == 0:
+        await rebuild_availability(tenant_id, month, default_duration)
+
+async def apply_availability(reservation: dict, default_duration: int, sign: int):
+    await apply_availability_increments(
+        reservation.get('tenant_id', DEFAULT_TENANT),
+        reservation['date'][:7],
+        availability_increments(reservation, default_duration, sign),
+        default_duration
+    )
+
+def service_slots(start: dt_time, end: dt_time) -> List[int]:
+    first = start.hour * 60 + start.minute
+    last = end.hour * 60 + end.minute
+    return list(range(first - first % SLOT_MINUTES, last + 1, SLOT_MINUTES))
+
+# Bulk import
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', '10000'))
+BULK_CONTACT_FIELDS = ('name', 'phone', 'email', 'notes')
+
+def parse_bulk_rows(body: bytes, content_type: str) -> list:
+    # CSV with a header row, or one JSON object per line
+    text = body.decode('utf-8-sig')
+    if 'csv' in content_type:
+        return list(csv.DictReader(io.StringIO(text)))
+    rows = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON on line {number}")
+    return rows
+
+def row_error(index: int, error) -> dict:
+    if isinstance(error, HTTPException):
+        detail = error.detail
+    elif hasattr(error, 'errors'):
+        detail = '; '.join(f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors())
+    else:
+        detail = str(error)
+    return {'row': index, 'status': 'error', 'detail': detail}
+
+# Serialization
+class ModelSerializer:
+    # Shapes a trusted Mongo document like model(**document).model_dump()
+    # without validating it: only the model's fields, with their defaults
+    # filled in for documents written before a field existed. Excluded
+    # fields are not read from Mongo and come out as their defaults.
+    def __init__(self, model, exclude: frozenset):
+        self.fields = list(model.model_fields)
+        self.projection = {'_id': 0, **{name: 1 for name in self.fields if name not in exclude}}
+        self.defaults = {}
+        for name in self.fields:
+            field = model.model_fields[name]
+            if field.default_factory in (list, dict):
+                self.defaults[name] = field.default_factory()
+            elif not field.is_required() and field.default_factory is None:
+                self.defaults[name] = field.default
+
+    def dump(self, document: dict) -> dict:
+        defaults = self.defaults
+        return {name: document.get(name, defaults.get(name)) for name in self.fields}
+
+@lru_cache(maxsize=None)
+def model_serializer(model, exclude: frozenset = frozenset()) -> ModelSerializer:
+    return ModelSerializer(model, exclude)
+
+# Pagination
+PAGE_LIMIT = int(os.environ.get('PAGE_LIMIT', '1000'))
+
+# Sort orders used as keysets; the last key must be unique
+INSERTION_ORDER = [('_id', 1)]
+RESERVATION_ORDER = [('created_at', 1), ('reservation_id', 1)]
+RESERVATION_PROJECTION = {'_id': 0, 'day': 0, 'start_minute': 0}
+HACCP_ORDER = [('created_at', -1), ('record_id', -1)]
+
+def encode_cursor(document: dict, order: list) -> str:
+    values = [document.get(field) for field, _ in order]
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str, order: list) -> dict:
+    # Turns a cursor into a filter matching documents strictly after it
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(order):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    clauses = []
+    for index, (field, direction) in enumerate(order):
+        clause = {f: v for (f, _), v in zip(order[:index], values)}
+        clause[field] = {'$gt' if direction == 1 else '$lt': values[index]}
+        clauses.append(clause)
+    return {'$or': clauses}
+
+async def stream_ndjson(mongo_cursor, serializer: 'ModelSerializer'):
+    async for document in mongo_cursor:
+        yield encode_json(serializer.dump(document)) + b'\n'
+
+async def list_page(collection, query: dict, order: list, model,
+                    limit: int, cursor: Optional[str], stream: bool, exclude: frozenset = frozenset()):
+    # Keyset pagination: returns one page and sets X-Next-Cursor when more
+    # documents follow. With stream=True every matching document is
+    # written out as NDJSON straight from the database cursor. Documents
+    # were validated on write, so they are shaped by the model's
+    # serializer instead of being validated again by response_model.
+    serializer = model_serializer(model, exclude)
+    if cursor:
+        query = {'$and': [query, decode_cursor(cursor, order)]} if query else decode_cursor(cursor, order)
+    projection = {**serializer.projection, **{field: 1 for field, _ in order}}
+    mongo_cursor = collection.find(query, projection).sort(order)
+    if stream:
+        return StreamingResponse(stream_ndjson(mongo_cursor, serializer), media_type='application/x-ndjson')
+    documents = await mongo_cursor.limit(limit + 1).to_list(limit + 1)
+    headers = {}
+    if len(documents) > limit:
+        documents = documents[:limit]
+        headers['X-Next-Cursor'] = encode_cursor(documents[-1], order)
+    started = monotonic()
+    content = [serializer.dump(document) for document in documents]
+    track_phase('serialize', monotonic() - started)
+    return FastJSONResponse(content, headers=headers)
+
+# Blob store
+BLOB_DIR = Path(os.environ.get('BLOB_DIR', str(ROOT_DIR / 'blobs')))
+BLOB_CHUNK_SIZE = 64 * 1024
+BLOB_MAX_SIZE = int(os.environ.get('BLOB_MAX_SIZE', str(10 * 1024 * 1024)))
+# Room for the boundaries, part headers and other fields of an upload
+BLOB_MULTIPART_OVERHEAD = 64 * 1024
+BLOB_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+DATA_URL_PATTERN = re.compile(r'^data:([\w.+-]+/[\w.+-]+)?(;base64)?,(.*)$', re.DOTALL)
+
+class MultipartUpload:
+    # One file field of a multipart/form-data body, parsed straight off the
+    # request stream so nothing is spooled before the size cap applies.
+    # content_type is known once the first chunk has been yielded.
+    def __init__(self, request: Request, field: str):
+        self.request = request
+        self.field = field
+        self.content_type = None
+
+    async def chunks(self):
+        limit = BLOB_MAX_SIZE + BLOB_MULTIPART_OVERHEAD
+        declared = self.request.headers.get('content-length', '')
+        if declared.isdigit() and int(declared) > limit:
+            raise HTTPException(status_code=413, detail=f"Files are limited to {BLOB_MAX_SIZE} bytes")
+        kind, options = parse_options_header(self.request.headers.get('content-type', ''))
+        if kind != b'multipart/form-data' or not options.get(b'boundary'):
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+        
+        headers, field, value = {}, [], []
+        ours = found = False
+        received = []
+        
+        def on_part_begin():
+            headers.clear()
+        
+        def on_header_field(data, start, end):
+            field.append(data[start:end])
+        
+        def on_header_value(data, start, end):
+            value.append(data[start:end])
+        
+        def on_header_end():
+            headers[b''.join(field).lower()] = b''.join(value)
+            field.clear()
+            value.clear()
+        
+        def on_headers_finished():
+            nonlocal ours, found
+            _, disposition = parse_options_header(headers.get(b'content-disposition', b''))
+            ours = not found and disposition.get(b'name') == self.field.encode() and b'filename' in disposition
+            if ours:
+                found = True
+                self.content_type = headers.get(b'content-type', b'').decode('latin-1') or None
+        
+        def on_part_data(data, start, end):
+            if ours:
+                received.append(data[start:end])
+        
+        def on_part_end():
+            nonlocal ours
+            ours = False
+        
+        parser = MultipartParser(options[b'boundary'], {
+            'on_part_begin': on_part_begin,
+            'on_header_field': on_header_field,
+            'on_header_value': on_header_value,
+            'on_header_end': on_header_end,
+            'on_headers_finished': on_headers_finished,
+            'on_part_data': on_part_data,
+            'on_part_end': on_part_end
+        })
+        total = 0
+        try:
+            async for chunk in self.request.stream():
+                # Bodies sent without a Content-Length are capped as they arrive
+                total += len(chunk)
+                if total > limit:
+                    raise HTTPException(status_code=413, detail=f"Files are limited to {BLOB_MAX_SIZE} bytes")
+                parser.write(chunk)
+                for data in received:
+                    yield data
+                received.clear()
+            parser.finalize()
+        except MultipartParseError:
+            raise HTTPException(status_code=400, detail="Invalid multipart upload")
+        if not found:
+            raise HTTPException(status_code=400, detail=f"Missing file field '{self.field}'")
+
+class BlobStore:
+    # Content-addressed files named by their SHA-256, so identical
+    # uploads are stored once and never change once written
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path_for(self, blob_id: str) -> Path:
+        return self.root / blob_id[:2] / blob_id
+
+    def _open_temp(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.root, prefix='upload-', delete=False)
+
+    def _commit(self, temp_path: str, blob_id: str):
+        path = self.path_for(blob_id)
+        if path.exists():
+            os.unlink(temp_path)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(temp_path, path)
+
+    async def _record(self, blob_id: str, size: int, content_type: str, original_size: Optional[int] = None) -> dict:
+        blob = {
+            'blob_id': blob_id,
+            'size': size,
+            'content_type': content_type,
+            'created_at': datetime.now(timezone.utc)
+        }
+        if original_size is not None:
+            blob['original_size'] = original_size
+        await db.blobs.update_one({'blob_id': blob_id}, {'$setOnInsert': blob}, upsert=True)
+        return blob
+
+    async def put_upload(self, upload: MultipartUpload) -> dict:
+        # Writes the upload to disk chunk by chunk as it arrives while
+        # hashing it; stops reading with 413 once it grows past BLOB_MAX_SIZE
+        digest = hashlib.sha256()
+        size = 0
+        temp = await asyncio.to_thread(self._open_temp)
+        try:
+            async for chunk in upload.chunks():
+                size += len(chunk)
+                if size > BLOB_MAX_SIZE:
+                    raise HTTPException(status_code=413, detail=f"Files are limited to {BLOB_MAX_SIZE} bytes")
+                digest.update(chunk)
+                await asyncio.to_thread(temp.write, chunk)
+            await asyncio.to_thread(temp.close)
+            blob_id = digest.hexdigest()
+            await asyncio.to_thread(self._commit, temp.name, blob_id)
+        except Exception:
+            temp.close()
+            if os.path.exists(temp.name):
+                os.unlink(temp.name)
+            raise
+        return await self._record(blob_id, size, upload.content_type or 'application/octet-stream')
+
+    async def put_bytes(self, data: bytes, content_type: str, original_size: Optional[int] = None) -> dict:
+        blob_id = hashlib.sha256(data).hexdigest()
+        if not await asyncio.to_thread(self.path_for(blob_id).exists):
+            def write():
+                with self._open_temp() as temp:
+                    temp.write(data)
+                self._commit(temp.name, blob_id)
+            await asyncio.to_thread(write)
+        return await self._record(blob_id, len(data), content_type, original_size)
+
+    def read_range(self, blob_id: str, start: int, end: int):
+        with open(self.path_for(blob_id), 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(BLOB_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+blob_store = BlobStore(BLOB_DIR)
+
+def decode_data_url(value: str):
+    # Returns (content_type, data) of a base64 data URL
+    match = DATA_URL_PATTERN.match(value)
+    if not match or not match.group(2):
+        raise HTTPException(status_code=400, detail="Invalid data URL")
+    try:
+        data = base64.b64decode(match.group(3), validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid data URL")
+    return match.group(1) or 'application/octet-stream', data
+
+# Image pipeline
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+SIGNATURE_MAX_SIZE = 800
+PHOTO_MAX_SIZE = 1600
+THUMBNAIL_SIZE = 240
+
+def process_image(data: bytes, kind: str) -> dict:
+    # Runs in the image worker processes. Signatures are trimmed to their
+    # strokes and stored as lossless WebP; photos are downscaled and stored
+    # as lossy WebP. Both get a small WebP thumbnail.
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        if kind == 'signature':
+            image = image.convert('RGBA')
+            bbox = image.getchannel('A').getbbox()
+            if bbox:
+                image = image.crop(bbox)
+            image.thumbnail((SIGNATURE_MAX_SIZE, SIGNATURE_MAX_SIZE))
+            save_options = {'lossless': True, 'method': 6}
+        else:
+            image = image.convert('RGB')
+            image.thumbnail((PHOTO_MAX_SIZE, PHOTO_MAX_SIZE))
+            save_options = {'quality': 80, 'method': 6}
+        output = io.BytesIO()
+        image.save(output, 'WEBP', **save_options)
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        thumbnail = io.BytesIO()
+        image.save(thumbnail, 'WEBP', quality=70)
+    return {'image': output.getvalue(), 'thumbnail': thumbnail.getvalue(), 'content_type': 'image/webp'}
+
+class ImagePipeline:
+    # Re-encodes uploaded images on a process pool. Without Pillow, or for
+    # anything that is not an image, the original bytes are stored as is.
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.images = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.thumbnail_bytes = 0
+        self.latency = LatencyStats()
+
+    async def process(self, data: bytes, content_type: str, kind: str) -> Optional[dict]:
+        if Image is None or not content_type.startswith('image/'):
+            return None
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        started = monotonic()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, process_image, data, kind)
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Image processing failed, storing original: {str(e)}")
+            return None
+        self.latency.observe(monotonic() - started)
+        if len(result['image']) >= len(data):
+            # Already compact; keep the original but still use the thumbnail
+            result['image'] = data
+            result['content_type'] = content_type
+        self.images += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(result['image'])
+        self.thumbnail_bytes += len(result['thumbnail'])
+        return result
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+    def snapshot(self) -> dict:
+        return {
+            'images': self.images,
+            'failures': self.failures,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+            'thumbnail_bytes': self.thumbnail_bytes,
+            'latency': self.latency.snapshot()
         }
-        email = await asyncio.to_thread(resend.Emails.send, params)
-        return email
-    except Exception as e:
-        logger.error(f"Failed to send email: {str(e)}")
+
+image_pipeline = ImagePipeline(IMAGE_WORKERS)
+
+# Inline data URL fields of HACCP records: (blob field, thumbnail field, image kind)
+HACCP_BLOB_FIELDS = {
+    'signature': ('signature_blob', 'signature_thumbnail', 'signature'),
+    'photo_url': ('photo_blob', 'photo_thumbnail', 'photo'),
+}
+
+# List responses leave out inline legacy signatures and full-size references
+HACCP_LIST_PROJECTION = {'signature': 0, 'signature_blob': 0, 'photo_blob': 0}
+
+# Temperature series
+# Temperature readings are also kept in one bucket document per tenant,
+# equipment and day, holding the raw readings plus running daily and
+# hourly count/sum/min/max so reports never touch haccp_records
+TEMPERATURE_RAW_MAX_DAYS = 31
+TEMPERATURE_BACKFILL_BATCH = 500
+
+def as_utc(value) -> datetime:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def temperature_bucket_update(record: dict) -> Optional[tuple]:
+    # (filter, update) adding one reading to its bucket. The filter skips
+    # buckets already holding the record, so replaying a record ends in a
+    # duplicate key error on the upsert instead of counting it twice.
+    value = record.get('numeric_value')
+    if record.get('record_type') != HACCPType.temperature or value is None:
         return None
+    created_at = as_utc(record['created_at'])
+    hour = f'hours.{created_at.hour:02d}'
+    return (
+        {
+            'tenant_id': record.get('tenant_id', DEFAULT_TENANT),
+            'equipment_product': record['equipment_product'],
+            'date': created_at.date().isoformat(),
+            'readings.record_id': {'$ne': record['record_id']}
+        },
+        {
+            '$push': {'readings': {'at': created_at, 'value': value, 'record_id': record['record_id']}},
+            '$inc': {'count': 1, 'sum': value, f'{hour}.count': 1, f'{hour}.sum': value},
+            '$min': {'min': value, f'{hour}.min': value},
+            '$max': {'max': value, f'{hour}.max': value}
+        }
+    )
+
+async def record_temperature(record: dict):
+    update = temperature_bucket_update(record)
+    if update:
+        try:
+            await db.temperature_buckets.update_one(*update, upsert=True)
+        except DuplicateKeyError:
+            pass
+
+async def backfill_temperature_buckets():
+    # Builds the buckets from existing records in _id order. The last _id
+    # is checkpointed in db.migrations, so an interrupted run resumes where
+    # it stopped; readings already in a bucket are skipped, so it is safe
+    # to run on several workers at once.
+    checkpoint = await db.migrations.find_one({'_id': 'temperature_buckets.backfill'}) or {}
+    if checkpoint.get('done'):
+        return
+    last_id = checkpoint.get('last_id')
+    query = {'record_type': HACCPType.temperature.value}
+    while True:
+        page = {**query, '_id': {'$gt': last_id}} if last_id else query
+        records = await db.haccp_records.find(
+            page,
+            {'_id': 1, 'record_id': 1, 'tenant_id': 1, 'record_type': 1, 'equipment_product': 1, 'value': 1, 'created_at': 1}
+        ).sort('_id', 1).limit(TEMPERATURE_BACKFILL_BATCH).to_list(TEMPERATURE_BACKFILL_BATCH)
+        if not records:
+            break
+        batch = []
+        for record in records:
+            record['numeric_value'] = parse_reading(record.get('value'))
+            update = temperature_bucket_update(record)
+            if update:
+                batch.append(UpdateOne(*update, upsert=True))
+        if batch:
+            await write_temperature_batch(batch)
+        last_id = records[-1]['_id']
+        await db.migrations.update_one(
+            {'_id': 'temperature_buckets.backfill'},
+            {'$set': {'last_id': last_id}},
+            upsert=True
+        )
+    await db.migrations.update_one({'_id': 'temperature_buckets.backfill'}, {'$set': {'done': True}}, upsert=True)
+
+async def write_temperature_batch(batch: List[UpdateOne]):
+    try:
+        await db.temperature_buckets.bulk_write(batch, ordered=False)
+    except BulkWriteError as e:
+        # Readings another worker already added
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+
+def rollup(stats: dict) -> dict:
+    return {
+        'count': stats['count'],
+        'min': stats['min'],
+        'max': stats['max'],
+        'avg': round(stats['sum'] / stats['count'], 2) if stats['count'] else None
+    }
+
+# HACCP alerts
+HACCP_EVAL_SECONDS = float(os.environ.get('HACCP_EVAL_SECONDS', '60'))
+
+DEFAULT_HACCP_RULES = [
+    {'rule_id': 'temperature-daily', 'record_type': 'temperature', 'min_count': 3,
+     'priority': 'high', 'message': 'Faltam registos de temperatura hoje'},
+    {'rule_id': 'cleaning-daily', 'record_type': 'cleaning', 'min_count': 2,
+     'priority': 'medium', 'message': 'Faltam registos de limpeza hoje'},
+]
+
+def parse_reading(value: Optional[str]) -> Optional[float]:
+    # "4.5", "4,5 ºC", "-18°C" -> float; None when there is no number
+    match = re.search(r'-?\d+(?:[.,]\d+)?', value or '')
+    return float(match.group().replace(',', '.')) if match else None
+
+async def load_haccp_rules(tenant_id: str) -> List[HACCPRule]:
+    document = await db.haccp_rules.find_one({'tenant_id': tenant_id}, {'_id': 0})
+    return [HACCPRule(**rule) for rule in (document['rules'] if document else DEFAULT_HACCP_RULES)]
+
+async def evaluate_rule(tenant_id: str, rule: HACCPRule, now: datetime) -> Optional[dict]:
+    start = datetime.combine(now.date(), parse_time(rule.window_start), tzinfo=timezone.utc)
+    deadline = datetime.combine(now.date(), parse_time(rule.window_end), tzinfo=timezone.utc)
+    end = deadline + timedelta(minutes=1)
+    if now < start:
+        return None
+    query = {'tenant_id': tenant_id, 'record_type': rule.record_type.value, 'created_at': {'$gte': start, '$lt': end}}
+    if rule.equipment_product:
+        query['equipment_product'] = rule.equipment_product
+    bounds = []
+    if rule.min_value is not None:
+        bounds.append({'numeric_value': {'$lt': rule.min_value}})
+    if rule.max_value is not None:
+        bounds.append({'numeric_value': {'$gt': rule.max_value}})
+    if bounds:
+        query['$or'] = bounds
+    count = await db.haccp_records.count_documents(query)
+    if (count == 0) if bounds else (count >= rule.min_count):
+        return None
+    return {
+        'rule_id': rule.rule_id,
+        'type': 'warning',
+        'message': rule.message,
+        'priority': rule.priority,
+        'count': count,
+        # Records can still arrive until the window closes, so a missing
+        # count is shown as pending but only notified from the window's
+        # last minute on; a full-day rule at 23:59
+        'due': bool(bounds) or now >= deadline
+    }
+
+async def evaluate_haccp_alerts(tenant_id: str) -> dict:
+    # Stores today's alerts in haccp_alert_state. The version check makes
+    # one evaluator win each change, and only the winner sends the emails
+    # for alerts that just became due.
+    now = datetime.now(timezone.utc)
+    day = now.date().isoformat()
+    rules = await load_haccp_rules(tenant_id)
+    alerts = [alert for alert in await asyncio.gather(*(evaluate_rule(tenant_id, rule, now) for rule in rules)) if alert]
+    previous = await db.haccp_alert_state.find_one({'tenant_id': tenant_id, 'date': day}, {'_id': 0})
+    previous_ids = {alert['rule_id'] for alert in previous['alerts'] if alert.get('due', True)} if previous else set()
+    raised = [alert for alert in alerts if alert['due'] and alert['rule_id'] not in previous_ids]
+    transitions = dict(previous['transitions']) if previous else {}
+    for alert in raised:
+        transitions[alert['rule_id']] = transitions.get(alert['rule_id'], 0) + 1
+    version = previous['version'] if previous else 0
+    state = {
+        'tenant_id': tenant_id,
+        'date': day,
+        'alerts': alerts,
+        'transitions': transitions,
+        'evaluated_at': now,
+        'version': version + 1
+    }
+    if previous is None:
+        try:
+            await db.haccp_alert_state.insert_one(dict(state))
+        except DuplicateKeyError:
+            return await db.haccp_alert_state.find_one({'tenant_id': tenant_id, 'date': day}, {'_id': 0})
+    else:
+        result = await db.haccp_alert_state.update_one(
+            {'tenant_id': tenant_id, 'date': day, 'version': version},
+            {'$set': state}
+        )
+        if result.matched_count == 0:
+            return await db.haccp_alert_state.find_one({'tenant_id': tenant_id, 'date': day}, {'_id': 0})
+    critical = [alert for alert in raised if alert['priority'] == 'high']
+    if critical:
+        await notify_haccp_alerts(tenant_id, day, critical, transitions)
+    return state
+
+async def notify_haccp_alerts(tenant_id: str, day: str, alerts: List[dict], transitions: dict):
+    html = f"""
+            <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+                <h2 style="color: #f43f5e;">Alerta HACCP</h2>
+                <p>Existem registos HACCP pendentes:</p>
+                <ul>
+                {''.join([f'<li>{a["message"]}</li>' for a in alerts])}
+                </ul>
+                <p>Por favor, complete os registos em falta.</p>
+            </div>
+            """
+    key = ','.join(f"{alert['rule_id']}.{transitions[alert['rule_id']]}" for alert in alerts)
+    async for user in db.users.find({'tenant_id': tenant_id}, {'_id': 0, 'user_id': 1, 'email': 1}):
+        await send_email(
+            user['email'],
+            "Alerta HACCP - Registos Pendentes",
+            html,
+            idempotency_key=f"haccp-alert:{user['user_id']}:{day}:{key}"
+        )
+
+class HACCPAlertMonitor:
+    # Re-evaluates every tenant's rules each HACCP_EVAL_SECONDS, and a
+    # single tenant as soon as it logs a record or changes its rules
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.pending = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def wake(self, tenant_id: str):
+        self.pending.add(tenant_id)
+        self.event.set()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        # The sweep keeps its own deadline, so a steady stream of wakes
+        # from busy tenants cannot postpone the quiet ones
+        sweep_at = monotonic()
+        tenants = []
+        while True:
+            if monotonic() >= sweep_at:
+                tenants = None
+                sweep_at = monotonic() + HACCP_EVAL_SECONDS
+            try:
+                if tenants is None:
+                    tenants = await db.users.distinct('tenant_id')
+                for tenant_id in tenants:
+                    await evaluate_haccp_alerts(tenant_id)
+            except Exception as e:
+                logger.error(f"HACCP alert evaluation error: {str(e)}")
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout=max(sweep_at - monotonic(), 0))
+                tenants = list(self.pending)
+            except asyncio.TimeoutError:
+                tenants = []
+            self.event.clear()
+            self.pending.clear()
+
+haccp_alerts = HACCPAlertMonitor()
+
+def parse_range(header: str, size: int):
+    # Single "bytes=start-end" range; returns (start, end) or None if unsatisfiable
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end:
+        return None
+    return start, end
+
+# Indexes
+# (collection, keys, options) for every index the routes rely on
+INDEXES = [
+    ('users', [('user_id', 1)], {'unique': True}),
+    ('users', [('email', 1)], {'unique': True}),
+    ('tenants', [('tenant_id', 1)], {'unique': True}),
+    ('rooms', [('room_id', 1)], {'unique': True}),
+    ('rooms', [('tenant_id', 1), ('_id', 1)], {}),
+    ('tables', [('table_id', 1)], {'unique': True}),
+    ('tables', [('tenant_id', 1), ('_id', 1)], {}),
+    ('tables', [('room_id', 1)], {}),
+    ('settings', [('tenant_id', 1)], {'unique': True}),
+    ('reservations', [('reservation_id', 1)], {'unique': True}),
+    ('reservations', [('tenant_id', 1), ('date', 1), ('meal_type', 1), ('status', 1)], {}),
+    ('reservations', [('tenant_id', 1), ('date', 1), ('status', 1)], {}),
+    ('reservations', [('tenant_id', 1), ('status', 1), ('date', 1)], {}),
+    ('reservations', [('tenant_id', 1), ('created_at', 1), ('reservation_id', 1)], {}),
+    ('reservations', [('tenant_id', 1), ('day', 1), ('start_minute', 1)], {}),
+    ('haccp_records', [('record_id', 1)], {'unique': True}),
+    ('haccp_records', [('tenant_id', 1), ('record_type', 1), ('created_at', -1), ('record_id', -1)], {}),
+    ('haccp_records', [('tenant_id', 1), ('created_at', -1), ('record_id', -1)], {}),
+    ('haccp_records', [('tenant_id', 1), ('record_type', 1), ('equipment_product', 1), ('created_at', 1)], {}),
+    ('haccp_rules', [('tenant_id', 1)], {'unique': True}),
+    ('haccp_alert_state', [('tenant_id', 1), ('date', 1)], {'unique': True}),
+    ('temperature_buckets', [('tenant_id', 1), ('equipment_product', 1), ('date', 1)], {'unique': True}),
+    ('temperature_buckets', [('tenant_id', 1), ('date', 1)], {}),
+    ('equipment', [('equipment_id', 1)], {'unique': True}),
+    ('equipment', [('tenant_id', 1), ('_id', 1)], {}),
+    ('spaces', [('space_id', 1)], {'unique': True}),
+    ('spaces', [('tenant_id', 1), ('_id', 1)], {}),
+    ('service_capacity', [('tenant_id', 1), ('date', 1), ('meal_type', 1)], {'unique': True}),
+    ('table_claims', [('table_id', 1), ('date', 1), ('slot', 1), ('full', 1)], {
+        'unique': True, 'partialFilterExpression': {'full': True}
+    }),
+    ('table_claims', [('table_id', 1), ('date', 1), ('slot', 1)], {}),
+    ('table_claims', [('reservation_id', 1)], {}),
+    ('email_outbox', [('idempotency_key', 1)], {'unique': True}),
+    ('email_outbox', [('status', 1), ('next_attempt_at', 1)], {}),
+    ('blobs', [('blob_id', 1)], {'unique': True}),
+    ('availability', [('tenant_id', 1), ('month', 1)], {'unique': True}),
+    ('reference_versions', [('tenant_id', 1), ('collection', 1)], {'unique': True}),
+]
+
+# Single-tenant unique indexes replaced by tenant-prefixed ones above
+LEGACY_INDEXES = [
+    ('settings', 'settings_id_1'),
+    ('service_capacity', 'date_1_meal_type_1'),
+    ('availability', 'month_1'),
+    ('table_claims', 'table_id_1_date_1_slot_1'),
+]
+
+# Collections whose documents belong to one tenant
+TENANT_COLLECTIONS = [
+    'users', 'rooms', 'tables', 'settings', 'reservations', 'haccp_records',
+    'haccp_rules', 'haccp_alert_state', 'equipment', 'spaces', 'service_capacity', 'availability',
+]
+
+# (name, collection, filter, sort) of the query each route issues
+QUERY_SHAPES = [
+    ('get_current_user', 'users', {'user_id': 'x'}, None),
+    ('login', 'users', {'email': 'x@example.com'}, None),
+    ('get_settings', 'settings', {'tenant_id': 't'}, None),
+    ('get_rooms', 'rooms', {'tenant_id': 't'}, INSERTION_ORDER),
+    ('get_tables', 'tables', {'tenant_id': 't'}, INSERTION_ORDER),
+    ('get_equipment', 'equipment', {'tenant_id': 't'}, INSERTION_ORDER),
+    ('get_spaces', 'spaces', {'tenant_id': 't'}, INSERTION_ORDER),
+    ('get_reservations', 'reservations', {'tenant_id': 't'}, RESERVATION_ORDER),
+    ('get_reservations:date', 'reservations', {'tenant_id': 't', 'date': '2000-01-01'}, RESERVATION_ORDER),
+    ('get_reservations:status', 'reservations', {'tenant_id': 't', 'status': 'confirmed'}, RESERVATION_ORDER),
+    ('get_reservations:date_status', 'reservations', {
+        'tenant_id': 't', 'date': '2000-01-01', 'status': 'confirmed'
+    }, RESERVATION_ORDER),
+    ('update_reservation', 'reservations', {'reservation_id': 'x', 'tenant_id': 't'}, None),
+    ('get_dashboard_stats', 'reservations', {
+        'tenant_id': 't', 'day': {'$gte': datetime(2000, 1, 1)}, 'status': {'$ne': 'cancelled'}
+    }, [('day', 1), ('start_minute', 1)]),
+    ('rebuild_availability', 'reservations', {
+        'tenant_id': 't', 'day': {'$gte': datetime(2000, 1, 1), '$lt': datetime(2000, 2, 1)},
+        'status': {'$ne': 'cancelled'}
+    }, None),
+    ('get_haccp_records', 'haccp_records', {'tenant_id': 't'}, HACCP_ORDER),
+    ('get_haccp_records:type', 'haccp_records', {'tenant_id': 't', 'record_type': 'temperature'}, HACCP_ORDER),
+    ('evaluate_rule:any', 'haccp_records', {
+        'tenant_id': 't', 'record_type': 'temperature', 'created_at': {'$gte': datetime(2000, 1, 1)}
+    }, None),
+    ('evaluate_rule', 'haccp_records', {
+        'tenant_id': 't', 'record_type': 'temperature', 'equipment_product': 'x',
+        'created_at': {'$gte': datetime(2000, 1, 1), '$lt': datetime(2000, 1, 2)}
+    }, None),
+    ('get_temperature_report', 'temperature_buckets', {
+        'tenant_id': 't', 'date': {'$gte': '2000-01-01', '$lte': '2000-12-31'}
+    }, [('equipment_product', 1), ('date', 1)]),
+    ('get_temperature_report:equipment', 'temperature_buckets', {
+        'tenant_id': 't', 'equipment_product': 'x', 'date': {'$gte': '2000-01-01', '$lte': '2000-12-31'}
+    }, [('equipment_product', 1), ('date', 1)]),
+    ('get_dashboard_stats:haccp', 'haccp_records', {'tenant_id': 't', 'created_at': {'$gte': datetime(2000, 1, 1)}}, None),
+    ('reserve_capacity', 'service_capacity', {'tenant_id': 't', 'date': '2000-01-01', 'meal_type': 'jantar'}, None),
+    ('get_availability', 'availability', {'tenant_id': 't', 'month': '2000-01'}, None),
+    ('release_tables', 'table_claims', {'reservation_id': 'x'}, None),
+    ('create_reservation:claims', 'table_claims', {
+        'table_id': {'$in': ['x']}, 'date': '2000-01-01', 'slot': {'$in': [80]}
+    }, None),
+    ('bulk_import_reservations:claims', 'table_claims', {'table_id': {'$in': ['x']}, 'date': {'$in': ['2000-01-01']}}, None),
+    ('claim_conflicts', 'table_claims', {
+        'table_id': {'$in': ['x']}, 'date': '2000-01-01', 'slot': {'$in': [80]}, 'reservation_id': {'$nin': ['x']}
+    }, None),
+    ('email_outbox', 'email_outbox', {'status': 'pending', 'next_attempt_at': {'$lte': '2000-01-01'}}, [('next_attempt_at', 1)]),
+]
+
+async def ensure_indexes():
+    for collection, keys, options in INDEXES:
+        await db[collection].create_index(keys, **options)
+
+async def migrate_tenancy():
+    # Documents written before multi-tenancy belong to the default tenant
+    for collection in TENANT_COLLECTIONS:
+        await db[collection].update_many(
+            {'tenant_id': {'$exists': False}},
+            {'$set': {'tenant_id': DEFAULT_TENANT}}
+        )
+    for collection, name in LEGACY_INDEXES:
+        # Only while still unique; a plain index may reuse the name
+        if (await db[collection].index_information()).get(name, {}).get('unique'):
+            await db[collection].drop_index(name)
+
+# Date migration
+DATE_MIGRATION_BATCH = int(os.environ.get('DATE_MIGRATION_BATCH', '1000'))
+
+def created_at_to_date(document: dict) -> dict:
+    try:
+        return {'created_at': as_utc(document['created_at'])}
+    except ValueError:
+        return {}
+
+def claim_interval(document: dict) -> dict:
+    # Claims written before intervals were stored covered their whole slot
+    start = document['slot'] * SLOT_MINUTES
+    return {'full': True, 'start': start, 'end': start + SLOT_MINUTES}
+
+def schedule_fields(document: dict) -> dict:
+    try:
+        return reservation_schedule(document['date'], document['time'])
+    except (KeyError, ValueError):
+        return {}
+
+# (name, collection, filter, projection, convert) for each conversion;
+# convert returns the $set for one document, or {} to leave it alone
+DATE_MIGRATIONS = [
+    ('users.created_at', 'users', {'created_at': {'$type': 'string'}}, {'created_at': 1}, created_at_to_date),
+    ('reservations.created_at', 'reservations', {'created_at': {'$type': 'string'}}, {'created_at': 1}, created_at_to_date),
+    ('haccp_records.created_at', 'haccp_records', {'created_at': {'$type': 'string'}}, {'created_at': 1}, created_at_to_date),
+    ('reservations.schedule', 'reservations', {'day': {'$exists': False}}, {'date': 1, 'time': 1}, schedule_fields),
+    ('table_claims.interval', 'table_claims', {'full': {'$exists': False}}, {'slot': 1}, claim_interval),
+]
+
+async def run_date_migration(name: str, collection: str, query: dict, projection: dict, convert, batch_size: int) -> int:
+    # Converts matching documents in _id order, batch_size at a time. The
+    # last _id is checkpointed in db.migrations, so an interrupted run
+    # resumes where it stopped; documents it could not convert are skipped.
+    checkpoint = await db.migrations.find_one({'_id': name}) or {}
+    if checkpoint.get('done'):
+        return 0
+    last_id = checkpoint.get('last_id')
+    converted = 0
+    while True:
+        page = {'$and': [query, {'_id': {'$gt': last_id}}]} if last_id else query
+        batch = await db[collection].find(page, projection).sort('_id', 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        updates = []
+        for document in batch:
+            fields = convert(document)
+            if fields:
+                updates.append(UpdateOne({'_id': document['_id']}, {'$set': fields}))
+        if updates:
+            await db[collection].bulk_write(updates, ordered=False)
+        converted += len(updates)
+        last_id = batch[-1]['_id']
+        await db.migrations.update_one(
+            {'_id': name},
+            {'$set': {'last_id': last_id}, '$inc': {'converted': len(updates)}},
+            upsert=True
+        )
+    await db.migrations.update_one({'_id': name}, {'$set': {'done': True}}, upsert=True)
+    return converted
+
+async def run_date_migrations(batch_size: int = DATE_MIGRATION_BATCH):
+    for name, collection, query, projection, convert in DATE_MIGRATIONS:
+        converted = await run_date_migration(name, collection, query, projection, convert, batch_size)
+        if converted:
+            logger.info(f"Date migration {name}: converted {converted} documents")
+
+async def backfill_table_claims():
+    # Upcoming reservations seated before table claims existed get their
+    # claims, since allocation only reads claims. Runs once.
+    if (await db.migrations.find_one({'_id': 'table_claims.backfill'}) or {}).get('done'):
+        return
+    today = datetime.now(timezone.utc).date().isoformat()
+    backfilled = 0
+    async for reservation in db.reservations.find(
+        {'date': {'$gte': today}, 'status': {'$ne': 'cancelled'}, 'table_id': {'$ne': None}},
+        {'_id': 0, 'reservation_id': 1, 'tenant_id': 1, 'date': 1, 'time': 1, 'duration': 1, 'table_id': 1, 'table_ids': 1}
+    ):
+        if await db.table_claims.find_one({'reservation_id': reservation['reservation_id']}, {'_id': 1}):
+            continue
+        try:
+            start = time_to_minutes(reservation['time'])
+        except (KeyError, ValueError):
+            continue
+        duration = reservation.get('duration')
+        if not duration:
+            snapshot = await tenant_settings(reservation['tenant_id']).get()
+            duration = snapshot.avg_table_time if snapshot else 90
+        table_ids = reservation.get('table_ids') or [reservation['table_id']]
+        try:
+            await db.table_claims.insert_many(
+                table_claim_documents(reservation['reservation_id'], reservation['date'], table_ids, start, start + duration),
+                ordered=False
+            )
+        except BulkWriteError:
+            # Overlapping legacy bookings keep whatever claims fit
+            pass
+        backfilled += 1
+    await db.migrations.update_one({'_id': 'table_claims.backfill'}, {'$set': {'done': True}}, upsert=True)
+    if backfilled:
+        logger.info(f"Table claims backfilled for {backfilled} reservations")
+
+def plan_stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(plan_stages(item))
+    return stages
+
+async def verify_query_plans():
+    # Explains every route query and fails if any would scan a whole collection
+    failures = []
+    for name, collection, query, sort in QUERY_SHAPES:
+        command = {'find': collection, 'filter': query}
+        if sort:
+            command['sort'] = dict(sort)
+        explained = await db.command({'explain': command, 'verbosity': 'queryPlanner'})
+        stages = plan_stages(explained['queryPlanner']['winningPlan'])
+        if 'COLLSCAN' in stages:
+            failures.append(f"{name} ({collection}): {' <- '.join(stages)}")
+    if failures:
+        raise RuntimeError("Queries without index support: " + "; ".join(failures))
+    logger.info(f"Verified query plans for {len(QUERY_SHAPES)} route queries")
 
 # Auth routes
-@api_router.post("/auth/register")
-async def register(user_data: UserCreate):
+async def new_user(user_data: UserCreate) -> dict:
     existing = await db.users.find_one({'email': user_data.email}, {'_id': 0})
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    user_dict = {
+    return {
         'user_id': str(uuid.uuid4()),
         'name': user_data.name,
         'email': user_data.email,
-        'password': hash_password(user_data.password),
+        'password': await password_pool.run('hash', hash_password, user_data.password),
         'role': 'admin',
-        'created_at': datetime.now(timezone.utc).isoformat()
+        'created_at': datetime.now(timezone.utc)
     }
-    
-    await db.users.insert_one(user_dict)
-    token = create_token(user_dict['user_id'])
+
+async def insert_user(user_dict: dict):
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+
+@api_router.post("/auth/register")
+async def register(user_data: UserCreate):
+    # Signing up creates a restaurant; the tenant is never chosen by the client
+    user_dict = await new_user(user_data)
+    user_dict['tenant_id'] = await create_tenant(user_dict['user_id'])
+    try:
+        await insert_user(user_dict)
+    except HTTPException:
+        await release_tenant(user_dict['tenant_id'], user_dict['user_id'])
+        raise
+    token = create_token(user_dict)
     
     return {
         'token': token,
@@ -279,103 +2531,162 @@ async def register(user_data: UserCreate):
             'user_id': user_dict['user_id'],
             'name': user_dict['name'],
             'email': user_dict['email'],
-            'role': user_dict['role']
+            'role': user_dict['role'],
+            'tenant_id': user_dict['tenant_id']
         }
     }
 
 @api_router.post("/auth/login")
 async def login(credentials: UserLogin):
     user = await db.users.find_one({'email': credentials.email}, {'_id': 0})
-    if not user or not verify_password(credentials.password, user['password']):
+    if not user or not await password_pool.run('verify', verify_password, credentials.password, user['password']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    token = create_token(user['user_id'])
+    token = create_token(user)
     return {
         'token': token,
         'user': {
             'user_id': user['user_id'],
             'name': user['name'],
             'email': user['email'],
-            'role': user['role']
+            'role': user['role'],
+            'tenant_id': user.get('tenant_id', DEFAULT_TENANT)
         }
     }
 
+@api_router.post("/auth/users")
+async def create_user(user_data: UserCreate, current_user: dict = Depends(get_current_user)):
+    # Adds an account to the caller's restaurant
+    user_dict = await new_user(user_data)
+    user_dict['tenant_id'] = current_user['tenant_id']
+    await insert_user(user_dict)
+    return {
+        'user_id': user_dict['user_id'],
+        'name': user_dict['name'],
+        'email': user_dict['email'],
+        'role': user_dict['role'],
+        'tenant_id': user_dict['tenant_id']
+    }
+
 @api_router.get("/auth/me")
 async def get_me(current_user: dict = Depends(get_current_user)):
     return {
         'user_id': current_user['user_id'],
         'name': current_user['name'],
         'email': current_user['email'],
-        'role': current_user['role']
+        'role': current_user['role'],
+        'tenant_id': current_user['tenant_id']
     }
 
+@api_router.get("/auth/password-metrics")
+async def get_password_metrics(current_user: dict = Depends(get_current_user)):
+    return password_pool.snapshot()
+
+@api_router.delete("/auth/users/{user_id}")
+async def delete_user(user_id: str, current_user: dict = Depends(get_current_user)):
+    result = await db.users.delete_one({'user_id': user_id, 'tenant_id': current_user['tenant_id']})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    await revoke_user_sessions(user_id)
+    return {'message': 'User deleted successfully'}
+
+@api_router.post("/auth/users/{user_id}/revoke")
+async def revoke_sessions(user_id: str, current_user: dict = Depends(get_current_user)):
+    # Signs the user out everywhere; tokens from the next login still work
+    result = await db.users.update_one(
+        {'user_id': user_id, 'tenant_id': current_user['tenant_id']},
+        {'$inc': {'token_version': 1}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    await revoke_user_sessions(user_id)
+    return {'message': 'Sessions revoked successfully'}
+
 # Rooms routes
 @api_router.get("/rooms", response_model=List[Room])
-async def get_rooms(current_user: dict = Depends(get_current_user)):
-    rooms = await db.rooms.find({}, {'_id': 0}).to_list(1000)
-    return rooms
+async def get_rooms(
+    request: Request,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    return await reference_page(request, db.rooms, 'rooms', current_user['tenant_id'], Room, limit, cursor, stream)
 
 @api_router.post("/rooms", response_model=Room)
 async def create_room(room_data: RoomCreate, current_user: dict = Depends(get_current_user)):
-    room = Room(**room_data.model_dump())
+    room = Room(**room_data.model_dump(), tenant_id=current_user['tenant_id'])
     await db.rooms.insert_one(room.model_dump())
+    await reference_versions.bump(current_user['tenant_id'], 'rooms')
     return room
 
 @api_router.put("/rooms/{room_id}", response_model=Room)
 async def update_room(room_id: str, room_data: RoomCreate, current_user: dict = Depends(get_current_user)):
     result = await db.rooms.update_one(
-        {'room_id': room_id},
+        {'room_id': room_id, 'tenant_id': current_user['tenant_id']},
         {'$set': room_data.model_dump()}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Room not found")
+    await reference_versions.bump(current_user['tenant_id'], 'rooms')
     
-    updated_room = await db.rooms.find_one({'room_id': room_id}, {'_id': 0})
+    updated_room = await db.rooms.find_one({'room_id': room_id, 'tenant_id': current_user['tenant_id']}, {'_id': 0})
     return updated_room
 
 @api_router.delete("/rooms/{room_id}")
 async def delete_room(room_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.rooms.delete_one({'room_id': room_id})
+    result = await db.rooms.delete_one({'room_id': room_id, 'tenant_id': current_user['tenant_id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Room not found")
+    await reference_versions.bump(current_user['tenant_id'], 'rooms')
     return {'message': 'Room deleted successfully'}
 
 # Tables routes
 @api_router.get("/tables", response_model=List[Table])
-async def get_tables(current_user: dict = Depends(get_current_user)):
-    tables = await db.tables.find({}, {'_id': 0}).to_list(1000)
-    return tables
+async def get_tables(
+    request: Request,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    return await reference_page(request, db.tables, 'tables', current_user['tenant_id'], Table, limit, cursor, stream)
 
 @api_router.post("/tables", response_model=Table)
 async def create_table(table_data: TableCreate, current_user: dict = Depends(get_current_user)):
-    table = Table(**table_data.model_dump())
+    table = Table(**table_data.model_dump(), tenant_id=current_user['tenant_id'])
     await db.tables.insert_one(table.model_dump())
+    await reference_versions.bump(current_user['tenant_id'], 'tables')
     return table
 
 @api_router.put("/tables/{table_id}", response_model=Table)
 async def update_table(table_id: str, table_data: TableCreate, current_user: dict = Depends(get_current_user)):
     result = await db.tables.update_one(
-        {'table_id': table_id},
+        {'table_id': table_id, 'tenant_id': current_user['tenant_id']},
         {'$set': table_data.model_dump()}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Table not found")
+    await reference_versions.bump(current_user['tenant_id'], 'tables')
     
-    updated_table = await db.tables.find_one({'table_id': table_id}, {'_id': 0})
+    updated_table = await db.tables.find_one({'table_id': table_id, 'tenant_id': current_user['tenant_id']}, {'_id': 0})
     return updated_table
 
 @api_router.delete("/tables/{table_id}")
 async def delete_table(table_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.tables.delete_one({'table_id': table_id})
+    result = await db.tables.delete_one({'table_id': table_id, 'tenant_id': current_user['tenant_id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Table not found")
+    await reference_versions.bump(current_user['tenant_id'], 'tables')
     return {'message': 'Table deleted successfully'}
 
 # Settings routes
 @api_router.get("/settings", response_model=Settings)
-async def get_settings():
-    settings = await db.settings.find_one({'settings_id': 'global'}, {'_id': 0})
-    if not settings:
+async def get_settings(request: Request, tenant_id: str = Depends(get_tenant_id)):
+    # get_tenant_id only lets registered tenants through, so defaults are
+    # written at most once per restaurant
+    snapshot = await tenant_settings(tenant_id).get()
+    if not snapshot:
         default_settings = Settings(
             open_days=[1, 2, 3, 4, 5, 6],
             lunch_start="12:00",
@@ -384,24 +2695,40 @@ async def get_settings():
             dinner_end="23:00",
             avg_table_time=90,
             max_capacity_lunch=50,
-            max_capacity_dinner=60
+            max_capacity_dinner=60,
+            tenant_id=tenant_id
         )
-        await db.settings.insert_one(default_settings.model_dump())
+        try:
+            await db.settings.insert_one(default_settings.model_dump())
+        except DuplicateKeyError:
+            pass
+        tenant_settings(tenant_id).invalidate()
         return default_settings
-    return settings
+    etag = f'"settings-{tenant_id}-{snapshot.version}"'
+    return not_modified(request, etag) or FastJSONResponse(
+        model_serializer(Settings).dump(snapshot.data),
+        headers=reference_headers(etag)
+    )
 
 @api_router.put("/settings", response_model=Settings)
 async def update_settings(settings_data: SettingsUpdate, current_user: dict = Depends(get_current_user)):
     settings_dict = settings_data.model_dump()
     settings_dict['settings_id'] = 'global'
+    settings_dict['tenant_id'] = current_user['tenant_id']
     
-    await db.settings.update_one(
-        {'settings_id': 'global'},
-        {'$set': settings_dict},
-        upsert=True
-    )
+    try:
+        SettingsSnapshot(settings_dict)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid time format: {str(e)}")
     
-    updated = await db.settings.find_one({'settings_id': 'global'}, {'_id': 0})
+    updated = await db.settings.find_one_and_update(
+        {'tenant_id': current_user['tenant_id']},
+        {'$set': settings_dict, '$inc': {'version': 1}},
+        projection={'_id': 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    tenant_settings(current_user['tenant_id']).invalidate()
     return updated
 
 # Reservations routes
@@ -409,85 +2736,89 @@ async def update_settings(settings_data: SettingsUpdate, current_user: dict = De
 async def get_reservations(
     date: Optional[str] = None,
     status: Optional[str] = None,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    stream: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
-    query = {}
+    query = {'tenant_id': current_user['tenant_id']}
     if date:
         query['date'] = date
     if status:
         query['status'] = status
     
-    reservations = await db.reservations.find(query, {'_id': 0}).to_list(1000)
-    return reservations
+    return await list_page(db.reservations, query, RESERVATION_ORDER, Reservation, limit, cursor, stream)
 
-@api_router.post("/reservations", response_model=Reservation)
-async def create_reservation(reservation_data: ReservationCreate):
+@api_router.post("/reservations", response_model=Reservation, dependencies=[Depends(limit_booking_ip)])
+async def create_reservation(
+    reservation_data: ReservationCreate,
+    tenant_id: str = Depends(get_tenant_id)
+):
+    await limit_booking_attempts(reservation_data)
+    
     # Get settings
-    settings = await db.settings.find_one({'settings_id': 'global'}, {'_id': 0})
+    settings = await tenant_settings(tenant_id).get()
     if not settings:
         raise HTTPException(status_code=400, detail="Settings not configured")
     
     # Validate date and time
     try:
-        reservation_date = datetime.strptime(reservation_data.date, "%Y-%m-%d")
-        day_of_week = reservation_date.weekday()
-        
-        # Check if day is open (Monday=0, Sunday=6)
-        if day_of_week not in settings['open_days']:
-            raise HTTPException(status_code=400, detail="Restaurant closed on this day")
+        meal_type, max_capacity = resolve_service(reservation_data.date, reservation_data.time, settings)
         
-        # Determine meal type
-        time_obj = datetime.strptime(reservation_data.time, "%H:%M").time()
-        lunch_start = datetime.strptime(settings['lunch_start'], "%H:%M").time()
-        lunch_end = datetime.strptime(settings['lunch_end'], "%H:%M").time()
-        dinner_start = datetime.strptime(settings['dinner_start'], "%H:%M").time()
-        dinner_end = datetime.strptime(settings['dinner_end'], "%H:%M").time()
-        
-        if lunch_start <= time_obj <= lunch_end:
-            meal_type = MealType.lunch
-            max_capacity = settings['max_capacity_lunch']
-        elif dinner_start <= time_obj <= dinner_end:
-            meal_type = MealType.dinner
-            max_capacity = settings['max_capacity_dinner']
-        else:
-            raise HTTPException(status_code=400, detail="Time not available for reservations")
-        
-        # Check capacity
-        existing_reservations = await db.reservations.find({
-            'date': reservation_data.date,
-            'meal_type': meal_type,
-            'status': {'$ne': 'cancelled'}
-        }, {'_id': 0}).to_list(1000)
-        
-        total_guests = sum(r.get('guests', 0) for r in existing_reservations)
-        if total_guests + reservation_data.guests > max_capacity:
+        # Reserve capacity atomically on the service counter
+        if not await reserve_capacity(tenant_id, reservation_data.date, meal_type, reservation_data.guests, max_capacity):
             raise HTTPException(status_code=400, detail="No capacity available for this time")
         
-        # Find available table
-        tables = await db.tables.find({}, {'_id': 0}).to_list(1000)
-        available_table = None
-        
-        # Get tables already reserved for this time
-        reserved_table_ids = [r.get('table_id') for r in existing_reservations if r.get('table_id')]
-        
-        # Find suitable table
-        for table in tables:
-            if table['table_id'] not in reserved_table_ids and table['capacity'] >= reservation_data.guests:
-                available_table = table['table_id']
-                break
-        
-        # Create reservation
         reservation = Reservation(
             **reservation_data.model_dump(),
             meal_type=meal_type,
-            table_id=available_table,
-            status=ReservationStatus.confirmed
+            duration=settings.avg_table_time,
+            status=ReservationStatus.confirmed,
+            tenant_id=tenant_id
         )
         
-        await db.reservations.insert_one(reservation.model_dump())
+        await ensure_availability_month(tenant_id, reservation_data.date[:7], settings.avg_table_time)
+        try:
+            # Find best-fit table free for the whole seating interval. Only
+            # the claims of tables that could seat the party, in the slots
+            # the interval touches, are read.
+            start = time_to_minutes(reservation_data.time)
+            end = start + reservation.duration
+            layout = await table_layout(tenant_id)
+            allocator = TableAllocator(layout)
+            for _, table_ids, claimed_start, claimed_end in await claimed_intervals({
+                'table_id': {'$in': layout.candidates(reservation_data.guests)},
+                'date': reservation_data.date,
+                'slot': {'$in': list(interval_slots(start, end))}
+            }):
+                allocator.add(table_ids, claimed_start, claimed_end)
+            
+            for _ in range(CLAIM_ATTEMPTS):
+                table_ids = allocator.allocate(reservation_data.guests, start, end)
+                if not table_ids:
+                    break
+                if await claim_tables(reservation.reservation_id, reservation_data.date, table_ids, start, end):
+                    reservation.table_id = table_ids[0]
+                    reservation.table_ids = table_ids
+                    break
+                # Another booking claimed these tables first, try the next best fit
+                allocator.add(table_ids, start, end)
+            
+            await db.reservations.insert_one({
+                **reservation.model_dump(),
+                **reservation_schedule(reservation.date, reservation.time)
+            })
+        except Exception:
+            await release_tables(reservation.reservation_id)
+            await adjust_capacity(tenant_id, reservation_data.date, meal_type, -reservation_data.guests)
+            raise
+        
+        available_table = reservation.table_id
+        await apply_availability(reservation.model_dump(), settings.avg_table_time, 1)
+        change_feed.publish('reservation.created', reservation.model_dump())
         
         # Send confirmation email
-        if reservation_data.email and resend.api_key:
+        if reservation_data.email:
             html = f"""
             <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
                 <h2 style="color: #3b82f6;">Reserva Confirmada</h2>
@@ -502,13 +2833,207 @@ async def create_reservation(reservation_data: ReservationCreate):
                 <p>Aguardamos por si!</p>
             </div>
             """
-            await send_email(reservation_data.email, "Reserva Confirmada", html)
+            await send_email(
+                reservation_data.email,
+                "Reserva Confirmada",
+                html,
+                idempotency_key=f"reservation-confirmed:{reservation.reservation_id}"
+            )
         
         return reservation
         
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Invalid date or time format: {str(e)}")
 
+@api_router.post("/reservations/bulk")
+async def bulk_import_reservations(request: Request, current_user: dict = Depends(get_current_user)):
+    tenant_id = current_user['tenant_id']
+    settings = await tenant_settings(tenant_id).get()
+    if not settings:
+        raise HTTPException(status_code=400, detail="Settings not configured")
+    
+    rows = parse_bulk_rows(await request.body(), request.headers.get('content-type', ''))
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ROWS} rows per import")
+    results = [None] * len(rows)
+    
+    # Validate every row with the same rules as create_reservation
+    candidates = []
+    supplied_ids = set()
+    for index, row in enumerate(rows):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError("Row must be an object")
+            fields = {k: v for k, v in row.items() if v not in ('', None)}
+            data = ReservationCreate(**fields)
+            meal_type, max_capacity = resolve_service(data.date, data.time, settings)
+            reservation_id = fields.get('reservation_id')
+            if reservation_id is not None:
+                if not isinstance(reservation_id, str):
+                    raise ValueError("reservation_id must be a string")
+                if reservation_id in supplied_ids:
+                    raise ValueError("Duplicate reservation_id in this import")
+                supplied_ids.add(reservation_id)
+            candidates.append((index, data, meal_type, max_capacity, reservation_id))
+        except (HTTPException, ValueError, TypeError) as e:
+            results[index] = row_error(index, e)
+    
+    # Rows naming an existing reservation update its contact details
+    existing = {}
+    if supplied_ids:
+        async for reservation in db.reservations.find(
+            {'reservation_id': {'$in': list(supplied_ids)}},
+            {'_id': 0, 'reservation_id': 1, 'tenant_id': 1, 'date': 1, 'time': 1, 'guests': 1}
+        ):
+            existing[reservation['reservation_id']] = reservation
+    updates = []
+    new_rows = []
+    for candidate in candidates:
+        index, data, _, _, reservation_id = candidate
+        current = existing.get(reservation_id)
+        if current is None:
+            new_rows.append(candidate)
+        elif current.get('tenant_id', DEFAULT_TENANT) != tenant_id:
+            results[index] = row_error(index, ValueError("reservation_id is already in use"))
+        elif (current['date'], current['time'], current['guests']) != (data.date, data.time, data.guests):
+            results[index] = row_error(index, ValueError("Date, time or guests changed; use PUT to move a reservation"))
+        else:
+            contact = {field: getattr(data, field) for field in BULK_CONTACT_FIELDS}
+            updates.append(UpdateOne({'reservation_id': reservation_id, 'tenant_id': tenant_id}, {'$set': contact}))
+            results[index] = {'row': index, 'status': 'updated', 'reservation_id': reservation_id}
+            change_feed.publish('reservation.updated', {'reservation_id': reservation_id, 'tenant_id': tenant_id, **contact})
+    if updates:
+        await db.reservations.bulk_write(updates, ordered=False)
+    
+    # Admit rows per service in file order, then reserve each service's total at once
+    services = {}
+    for candidate in new_rows:
+        services.setdefault((candidate[1].date, candidate[2]), []).append(candidate)
+    accepted = []
+    for (date, meal_type), members in services.items():
+        max_capacity = members[0][3]
+        await ensure_service_counter(tenant_id, date, meal_type)
+        counter = await db.service_capacity.find_one(
+            {'tenant_id': tenant_id, 'date': date, 'meal_type': meal_type},
+            {'_id': 0, 'guests': 1}
+        )
+        booked = counter['guests']
+        admitted = []
+        for candidate in members:
+            if booked + candidate[1].guests <= max_capacity:
+                booked += candidate[1].guests
+                admitted.append(candidate)
+            else:
+                results[candidate[0]] = row_error(candidate[0], ValueError("No capacity available for this time"))
+        total = sum(candidate[1].guests for candidate in admitted)
+        if admitted and not await reserve_capacity(tenant_id, date, meal_type, total, max_capacity):
+            # A concurrent booking got in first; fall back to row by row
+            kept = []
+            for candidate in admitted:
+                if await reserve_capacity(tenant_id, date, meal_type, candidate[1].guests, max_capacity):
+                    kept.append(candidate)
+                else:
+                    results[candidate[0]] = row_error(candidate[0], ValueError("No capacity available for this time"))
+            admitted = kept
+        accepted.extend(admitted)
+    
+    # Plan tables for the whole batch against one read of the claims
+    layout = await table_layout(tenant_id)
+    allocators = {}
+    
+    def allocator_for(date):
+        if date not in allocators:
+            allocators[date] = TableAllocator(layout)
+        return allocators[date]
+    
+    dates = sorted({candidate[1].date for candidate in accepted})
+    if dates and layout.tables:
+        for date, table_ids, start, end in await claimed_intervals({
+            'table_id': {'$in': [t['table_id'] for t in layout.tables]},
+            'date': {'$in': dates}
+        }):
+            allocator_for(date).add(table_ids, start, end)
+    
+    reservations = []
+    claims = []
+    for index, data, meal_type, _, reservation_id in accepted:
+        reservation = Reservation(
+            **data.model_dump(),
+            meal_type=meal_type,
+            duration=settings.avg_table_time,
+            status=ReservationStatus.confirmed,
+            tenant_id=tenant_id
+        )
+        if reservation_id:
+            reservation.reservation_id = reservation_id
+        start = time_to_minutes(data.time)
+        end = start + reservation.duration
+        allocator = allocator_for(data.date)
+        table_ids = allocator.allocate(data.guests, start, end)
+        if table_ids:
+            reservation.table_id = table_ids[0]
+            reservation.table_ids = table_ids
+            allocator.add(table_ids, start, end)
+            claims.extend(table_claim_documents(reservation.reservation_id, data.date, table_ids, start, end))
+        reservations.append((index, reservation))
+    
+    # Claims lost to concurrent bookings leave those rows without a table
+    if claims:
+        lost = set()
+        try:
+            await db.table_claims.insert_many(claims, ordered=False)
+        except BulkWriteError as e:
+            lost = {claims[error['index']]['reservation_id'] for error in e.details['writeErrors']}
+        lost |= await claim_conflicts([claim for claim in claims if claim['reservation_id'] not in lost])
+        if lost:
+            await release_claims([claim for claim in claims if claim['reservation_id'] in lost])
+            claims = [claim for claim in claims if claim['reservation_id'] not in lost]
+            for _, reservation in reservations:
+                if reservation.reservation_id in lost:
+                    reservation.table_id = None
+                    reservation.table_ids = []
+    
+    failed = set()
+    if reservations:
+        for month in sorted({reservation.date[:7] for _, reservation in reservations}):
+            await ensure_availability_month(tenant_id, month, settings.avg_table_time)
+        try:
+            await db.reservations.insert_many(
+                [{**r.model_dump(), **reservation_schedule(r.date, r.time)} for _, r in reservations],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                index, reservation = reservations[error['index']]
+                failed.add(error['index'])
+                detail = "Reservation already exists" if error.get('code') == 11000 else "Insert failed"
+                results[index] = row_error(index, ValueError(detail))
+                await release_claims([claim for claim in claims if claim['reservation_id'] == reservation.reservation_id])
+                await adjust_capacity(tenant_id, reservation.date, reservation.meal_type, -reservation.guests)
+    
+    # Fold the inserted rows into the availability calendar, one update per month
+    months = {}
+    for position, (index, reservation) in enumerate(reservations):
+        if position in failed:
+            continue
+        results[index] = {
+            'row': index,
+            'status': 'created',
+            'reservation_id': reservation.reservation_id,
+            'table_id': reservation.table_id
+        }
+        change_feed.publish('reservation.created', reservation.model_dump())
+        increments = months.setdefault(reservation.date[:7], {})
+        for path, guests in availability_increments(reservation.model_dump(), settings.avg_table_time, 1).items():
+            increments[path] = increments.get(path, 0) + guests
+    for month, increments in months.items():
+        await apply_availability_increments(tenant_id, month, increments, settings.avg_table_time)
+    
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    return {'summary': summary, 'results': results}
+
 @api_router.put("/reservations/{reservation_id}", response_model=Reservation)
 async def update_reservation(
     reservation_id: str,
@@ -516,194 +3041,760 @@ async def update_reservation(
     current_user: dict = Depends(get_current_user)
 ):
     update_dict = {k: v for k, v in reservation_data.model_dump().items() if v is not None}
+    if 'table_id' in update_dict and 'table_ids' not in update_dict:
+        update_dict['table_ids'] = [update_dict['table_id']]
+    
+    tenant_id = current_user['tenant_id']
+    previous = await db.reservations.find_one({'reservation_id': reservation_id, 'tenant_id': tenant_id}, {'_id': 0})
+    if not previous:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    
+    current = {**previous, **update_dict}
+    was_active = previous.get('status') != ReservationStatus.cancelled
+    is_active = current.get('status') != ReservationStatus.cancelled
+    
+    # Reject a bad date or time before any claim is released
+    try:
+        schedule = reservation_schedule(current['date'], current['time'])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date or time format: {str(e)}")
+    
+    # A move can land in the other service, whose counter and
+    # availability the guests then belong to
+    if update_dict.keys() & {'date', 'time'}:
+        settings = await tenant_settings(tenant_id).get()
+        if not settings:
+            raise HTTPException(status_code=400, detail="Settings not configured")
+        update_dict['meal_type'], _ = resolve_service(current['date'], current['time'], settings)
+        current['meal_type'] = update_dict['meal_type']
+    
+    # Re-claim tables when the seating changes
+    if update_dict.keys() & {'date', 'time', 'table_id', 'table_ids', 'status'}:
+        await release_tables(reservation_id)
+        if is_active and current.get('table_ids'):
+            duration = current.get('duration')
+            if not duration:
+                settings = await tenant_settings(tenant_id).get()
+                duration = settings.avg_table_time if settings else 90
+            start = time_to_minutes(current['time'])
+            if not await claim_tables(reservation_id, current['date'], current['table_ids'], start, start + duration):
+                if was_active and previous.get('table_ids'):
+                    start = time_to_minutes(previous['time'])
+                    await claim_tables(reservation_id, previous['date'], previous['table_ids'], start, start + duration)
+                raise HTTPException(status_code=409, detail="Table already booked for this time")
+    
+    reschedules = bool(update_dict.keys() & {'date', 'time', 'guests', 'status'})
+    if reschedules:
+        snapshot = await tenant_settings(tenant_id).get()
+        default_duration = snapshot.avg_table_time if snapshot else 90
+        for reservation, active in ((previous, was_active), (current, is_active)):
+            if active:
+                await ensure_availability_month(tenant_id, reservation['date'][:7], default_duration)
     
     result = await db.reservations.update_one(
-        {'reservation_id': reservation_id},
-        {'$set': update_dict}
+        {'reservation_id': reservation_id, 'tenant_id': tenant_id},
+        {'$set': {**update_dict, **schedule}}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Reservation not found")
     
-    updated = await db.reservations.find_one({'reservation_id': reservation_id}, {'_id': 0})
+    # Move guests between service counters
+    moved = (previous['date'], previous['meal_type']) != (current['date'], current['meal_type'])
+    if moved or update_dict.keys() & {'guests', 'status'}:
+        if was_active:
+            await adjust_capacity(tenant_id, previous['date'], previous['meal_type'], -previous.get('guests', 0))
+        if is_active:
+            await adjust_capacity(tenant_id, current['date'], current['meal_type'], current.get('guests', 0))
+    
+    # Keep the availability calendar in step
+    if reschedules:
+        if was_active:
+            await apply_availability(previous, default_duration, -1)
+        if is_active:
+            await apply_availability(current, default_duration, 1)
+    
+    updated = await db.reservations.find_one(
+        {'reservation_id': reservation_id, 'tenant_id': tenant_id},
+        RESERVATION_PROJECTION
+    )
+    change_feed.publish('reservation.updated', updated)
     return updated
 
 @api_router.delete("/reservations/{reservation_id}")
 async def cancel_reservation(reservation_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.reservations.update_one(
-        {'reservation_id': reservation_id},
-        {'$set': {'status': ReservationStatus.cancelled}}
+    tenant_id = current_user['tenant_id']
+    snapshot = await tenant_settings(tenant_id).get()
+    default_duration = snapshot.avg_table_time if snapshot else 90
+    booked = await db.reservations.find_one({'reservation_id': reservation_id, 'tenant_id': tenant_id}, {'_id': 0, 'date': 1})
+    if booked is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    await ensure_availability_month(tenant_id, booked['date'][:7], default_duration)
+    
+    previous = await db.reservations.find_one_and_update(
+        {'reservation_id': reservation_id, 'tenant_id': tenant_id, 'status': {'$ne': ReservationStatus.cancelled}},
+        {'$set': {'status': ReservationStatus.cancelled}},
+        projection=RESERVATION_PROJECTION
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Reservation not found")
+    # None when it was already cancelled
+    if previous is not None:
+        await release_tables(reservation_id)
+        await adjust_capacity(tenant_id, previous['date'], previous['meal_type'], -previous.get('guests', 0))
+        await apply_availability(previous, default_duration, -1)
+        change_feed.publish('reservation.cancelled', {**previous, 'status': ReservationStatus.cancelled})
     
     return {'message': 'Reservation cancelled successfully'}
 
+# Availability routes
+@api_router.get("/availability")
+async def get_availability(
+    date_from: str = Query(..., alias='from'),
+    date_to: str = Query(..., alias='to'),
+    tenant_id: str = Depends(get_tenant_id)
+):
+    try:
+        first_day = datetime.strptime(date_from, "%Y-%m-%d").date()
+        last_day = datetime.strptime(date_to, "%Y-%m-%d").date()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date format: {str(e)}")
+    if last_day < first_day or (last_day - first_day).days >= AVAILABILITY_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range must cover 1 to {AVAILABILITY_MAX_DAYS} days")
+    
+    settings = await tenant_settings(tenant_id).get()
+    if not settings:
+        raise HTTPException(status_code=400, detail="Settings not configured")
+    
+    # One precomputed document per month in the range
+    months = sorted({(first_day + timedelta(days=n)).isoformat()[:7] for n in range((last_day - first_day).days + 1)})
+    documents = {}
+    for month in months:
+        document = await db.availability.find_one({'tenant_id': tenant_id, 'month': month}, {'_id': 0})
+        if document is None:
+            await rebuild_availability(tenant_id, month, settings.avg_table_time)
+            document = await db.availability.find_one({'tenant_id': tenant_id, 'month': month}, {'_id': 0})
+        documents[month] = document['services']
+    
+    services = [
+        (MealType.lunch, settings.lunch_start, settings.lunch_end, settings.data['max_capacity_lunch']),
+        (MealType.dinner, settings.dinner_start, settings.dinner_end, settings.data['max_capacity_dinner']),
+    ]
+    days = []
+    day = first_day
+    while day <= last_day:
+        date = day.isoformat()
+        entry = {'date': date, 'open': day.weekday() in settings.open_days, 'services': []}
+        if entry['open']:
+            booked_services = documents[date[:7]].get(date, {})
+            for meal_type, start, end, max_capacity in services:
+                booked = booked_services.get(meal_type.value, {})
+                remaining = max(max_capacity - booked.get('guests', 0), 0)
+                seated = booked.get('seated', {})
+                entry['services'].append({
+                    'meal_type': meal_type.value,
+                    'capacity': max_capacity,
+                    'booked': booked.get('guests', 0),
+                    'remaining': remaining,
+                    'slots': [
+                        {
+                            'time': f'{minute // 60:02d}:{minute % 60:02d}',
+                            'seated': seated.get(str(minute), 0),
+                            'remaining': remaining
+                        }
+                        for minute in service_slots(start, end)
+                    ]
+                })
+        days.append(entry)
+        day += timedelta(days=1)
+    
+    return {'from': date_from, 'to': date_to, 'days': days}
+
 # Equipment routes
 @api_router.get("/equipment", response_model=List[Equipment])
-async def get_equipment(current_user: dict = Depends(get_current_user)):
-    equipment = await db.equipment.find({}, {'_id': 0}).to_list(1000)
-    return equipment
+async def get_equipment(
+    request: Request,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    return await reference_page(request, db.equipment, 'equipment', current_user['tenant_id'], Equipment, limit, cursor, stream)
 
 @api_router.post("/equipment", response_model=Equipment)
 async def create_equipment(equipment_data: EquipmentCreate, current_user: dict = Depends(get_current_user)):
-    equipment = Equipment(**equipment_data.model_dump())
+    equipment = Equipment(**equipment_data.model_dump(), tenant_id=current_user['tenant_id'])
     await db.equipment.insert_one(equipment.model_dump())
+    await reference_versions.bump(current_user['tenant_id'], 'equipment')
     return equipment
 
 @api_router.delete("/equipment/{equipment_id}")
 async def delete_equipment(equipment_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.equipment.delete_one({'equipment_id': equipment_id})
+    result = await db.equipment.delete_one({'equipment_id': equipment_id, 'tenant_id': current_user['tenant_id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Equipment not found")
+    await reference_versions.bump(current_user['tenant_id'], 'equipment')
     return {'message': 'Equipment deleted successfully'}
 
 # Space routes
 @api_router.get("/spaces", response_model=List[Space])
-async def get_spaces(current_user: dict = Depends(get_current_user)):
-    spaces = await db.spaces.find({}, {'_id': 0}).to_list(1000)
-    return spaces
+async def get_spaces(
+    request: Request,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    return await reference_page(request, db.spaces, 'spaces', current_user['tenant_id'], Space, limit, cursor, stream)
 
 @api_router.post("/spaces", response_model=Space)
 async def create_space(space_data: SpaceCreate, current_user: dict = Depends(get_current_user)):
-    space = Space(**space_data.model_dump())
+    space = Space(**space_data.model_dump(), tenant_id=current_user['tenant_id'])
     await db.spaces.insert_one(space.model_dump())
+    await reference_versions.bump(current_user['tenant_id'], 'spaces')
     return space
 
 @api_router.delete("/spaces/{space_id}")
 async def delete_space(space_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.spaces.delete_one({'space_id': space_id})
+    result = await db.spaces.delete_one({'space_id': space_id, 'tenant_id': current_user['tenant_id']})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Space not found")
+    await reference_versions.bump(current_user['tenant_id'], 'spaces')
     return {'message': 'Space deleted successfully'}
 
+# Blob routes
+@api_router.post("/blobs")
+async def upload_blob(request: Request, current_user: dict = Depends(get_current_user)):
+    blob = await blob_store.put_upload(MultipartUpload(request, 'file'))
+    return {
+        'blob_id': blob['blob_id'],
+        'size': blob['size'],
+        'content_type': blob['content_type'],
+        'url': f"/api/blobs/{blob['blob_id']}"
+    }
+
+@api_router.get("/blobs/stats")
+async def get_blob_stats(current_user: dict = Depends(get_current_user)):
+    return image_pipeline.snapshot()
+
+@api_router.get("/blobs/{blob_id}")
+async def get_blob(blob_id: str, request: Request):
+    if not BLOB_ID_PATTERN.match(blob_id):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    # Blobs never change, so the hash is a strong validator. They hold
+    # signatures and photos, so shared caches must not keep them.
+    etag = f'"{blob_id}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Accept-Ranges': 'bytes',
+        'X-Content-Type-Options': 'nosniff',
+        'Content-Security-Policy': 'sandbox'
+    }
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+    
+    blob = await db.blobs.find_one({'blob_id': blob_id}, {'_id': 0})
+    if not blob or not blob_store.path_for(blob_id).exists():
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    size = blob['size']
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get('range')
+    if range_header and size > 0 and request.headers.get('if-range', etag) == etag:
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            raise HTTPException(status_code=416, detail="Range not satisfiable", headers={'Content-Range': f'bytes */{size}'})
+        start, end = byte_range
+        status_code = 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    headers['Content-Length'] = str(end - start + 1)
+    
+    return StreamingResponse(
+        blob_store.read_range(blob_id, start, end),
+        status_code=status_code,
+        media_type=blob['content_type'],
+        headers=headers
+    )
+
 # HACCP routes
 @api_router.get("/haccp", response_model=List[HACCPRecord])
 async def get_haccp_records(
     record_type: Optional[str] = None,
+    full: bool = False,
+    limit: int = Query(PAGE_LIMIT, ge=1, le=PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    stream: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
-    query = {}
+    query = {'tenant_id': current_user['tenant_id']}
     if record_type:
         query['record_type'] = record_type
     
-    records = await db.haccp_records.find(query, {'_id': 0}).sort('created_at', -1).to_list(1000)
-    return records
+    exclude = frozenset() if full else frozenset(HACCP_LIST_PROJECTION)
+    return await list_page(db.haccp_records, query, HACCP_ORDER, HACCPRecord, limit, cursor, stream, exclude)
 
 @api_router.post("/haccp", response_model=HACCPRecord)
 async def create_haccp_record(record_data: HACCPRecordCreate, current_user: dict = Depends(get_current_user)):
-    record = HACCPRecord(**record_data.model_dump())
+    record_dict = record_data.model_dump()
+    
+    # Keep signatures and photos in the blob store, not inline
+    for field, (blob_field, thumbnail_field, kind) in HACCP_BLOB_FIELDS.items():
+        value = record_dict.get(field)
+        if value and value.startswith('data:'):
+            content_type, data = decode_data_url(value)
+            if len(data) > BLOB_MAX_SIZE:
+                raise HTTPException(status_code=413, detail=f"Files are limited to {BLOB_MAX_SIZE} bytes")
+            processed = await image_pipeline.process(data, content_type, kind)
+            if processed:
+                blob = await blob_store.put_bytes(processed['image'], processed['content_type'], original_size=len(data))
+                thumbnail = await blob_store.put_bytes(processed['thumbnail'], 'image/webp')
+                record_dict[thumbnail_field] = thumbnail['blob_id']
+            else:
+                blob = await blob_store.put_bytes(data, content_type)
+            record_dict[field] = None
+            record_dict[blob_field] = blob['blob_id']
+    
+    record_dict['numeric_value'] = parse_reading(record_dict.get('value'))
+    record = HACCPRecord(**record_dict, tenant_id=current_user['tenant_id'])
     await db.haccp_records.insert_one(record.model_dump())
+    await record_temperature(record.model_dump())
+    haccp_alerts.wake(record.tenant_id)
+    change_feed.publish('haccp.created', record.model_dump(exclude=set(HACCP_LIST_PROJECTION)))
     return record
 
 @api_router.get("/haccp/alerts")
 async def get_haccp_alerts(current_user: dict = Depends(get_current_user)):
-    today = datetime.now(timezone.utc).date()
-    today_str = today.isoformat()
-    
-    # Check if temperature records exist for today
-    temp_records = await db.haccp_records.find({
-        'record_type': 'temperature',
-        'created_at': {'$gte': today_str}
-    }, {'_id': 0}).to_list(1000)
-    
-    # Check if cleaning records exist for today
-    cleaning_records = await db.haccp_records.find({
-        'record_type': 'cleaning',
-        'created_at': {'$gte': today_str}
-    }, {'_id': 0}).to_list(1000)
-    
-    alerts = []
-    if len(temp_records) < 3:
-        alerts.append({
-            'type': 'warning',
-            'message': 'Faltam registos de temperatura hoje',
-            'priority': 'high'
-        })
+    # Reads the state kept by the alert monitor; evaluates only if today
+    # has not been evaluated yet
+    tenant_id = current_user['tenant_id']
+    today = datetime.now(timezone.utc).date().isoformat()
+    state = await db.haccp_alert_state.find_one({'tenant_id': tenant_id, 'date': today}, {'_id': 0, 'alerts': 1})
+    if state is None:
+        state = await evaluate_haccp_alerts(tenant_id)
+    return {'alerts': state['alerts']}
+
+@api_router.get("/haccp/temperatures")
+async def get_temperature_report(
+    date_from: str = Query(..., alias='from'),
+    date_to: str = Query(..., alias='to'),
+    equipment_product: Optional[str] = None,
+    resolution: str = Query('day', pattern='^(day|hour|raw)$'),
+    current_user: dict = Depends(get_current_user)
+):
+    try:
+        first_day = datetime.strptime(date_from, "%Y-%m-%d").date()
+        last_day = datetime.strptime(date_to, "%Y-%m-%d").date()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date format: {str(e)}")
+    if last_day < first_day:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    if resolution == 'raw' and (last_day - first_day).days >= TEMPERATURE_RAW_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Raw readings cover at most {TEMPERATURE_RAW_MAX_DAYS} days")
     
-    if len(cleaning_records) < 2:
-        alerts.append({
-            'type': 'warning',
-            'message': 'Faltam registos de limpeza hoje',
-            'priority': 'medium'
-        })
+    query = {'tenant_id': current_user['tenant_id'], 'date': {'$gte': date_from, '$lte': date_to}}
+    if equipment_product:
+        query['equipment_product'] = equipment_product
+    projection = {'_id': 0, 'equipment_product': 1, 'date': 1, 'count': 1, 'sum': 1, 'min': 1, 'max': 1}
+    if resolution == 'hour':
+        projection['hours'] = 1
+    elif resolution == 'raw':
+        projection['readings'] = 1
     
-    # Send email alert if there are critical alerts
-    if alerts and current_user.get('email'):
-        critical_alerts = [a for a in alerts if a['priority'] == 'high']
-        if critical_alerts and resend.api_key:
-            html = f"""
-            <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-                <h2 style="color: #f43f5e;">Alerta HACCP</h2>
-                <p>Existem registos HACCP pendentes:</p>
-                <ul>
-                {''.join([f'<li>{a["message"]}</li>' for a in alerts])}
-                </ul>
-                <p>Por favor, complete os registos em falta.</p>
-            </div>
-            """
-            await send_email(current_user['email'], "Alerta HACCP - Registos Pendentes", html)
+    series = []
+    async for bucket in db.temperature_buckets.find(query, projection).sort([('equipment_product', 1), ('date', 1)]):
+        if resolution == 'day':
+            series.append({'equipment_product': bucket['equipment_product'], 'date': bucket['date'], **rollup(bucket)})
+        elif resolution == 'hour':
+            for hour, stats in sorted(bucket['hours'].items()):
+                series.append({
+                    'equipment_product': bucket['equipment_product'],
+                    'date': bucket['date'],
+                    'hour': int(hour),
+                    **rollup(stats)
+                })
+        else:
+            for reading in bucket['readings']:
+                series.append({
+                    'equipment_product': bucket['equipment_product'],
+                    'at': reading['at'],
+                    'value': reading['value'],
+                    'record_id': reading['record_id']
+                })
+    return {'resolution': resolution, 'series': series}
+
+@api_router.get("/haccp/rules", response_model=List[HACCPRule])
+async def get_haccp_rules(current_user: dict = Depends(get_current_user)):
+    return await load_haccp_rules(current_user['tenant_id'])
+
+@api_router.put("/haccp/rules", response_model=List[HACCPRule])
+async def update_haccp_rules(rules_data: HACCPRulesUpdate, current_user: dict = Depends(get_current_user)):
+    try:
+        for rule in rules_data.rules:
+            parse_time(rule.window_start)
+            parse_time(rule.window_end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid time format: {str(e)}")
+    
+    rules = [rule.model_dump() for rule in rules_data.rules]
+    await db.haccp_rules.update_one(
+        {'tenant_id': current_user['tenant_id']},
+        {'$set': {'rules': rules}},
+        upsert=True
+    )
+    haccp_alerts.wake(current_user['tenant_id'])
+    return rules
+
+# Event routes
+@api_router.post("/events/ticket")
+async def create_events_ticket(current_user: dict = Depends(get_current_user)):
+    return {'ticket': create_stream_ticket(current_user), 'expires_in': STREAM_TICKET_SECONDS}
+
+@api_router.get("/events")
+async def get_events(
+    request: Request,
+    ticket: Optional[str] = None,
+    last_event_id: Optional[str] = None
+):
+    # EventSource cannot send headers, so it passes a stream ticket from
+    # POST /events/ticket as a query parameter instead of the session token
+    authorization = request.headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        principal = await authenticate_token(authorization[7:])
+    elif ticket:
+        principal = await authenticate_token(ticket, scope='events')
+    else:
+        raise HTTPException(status_code=401, detail="Not authenticated")
     
-    return {'alerts': alerts}
+    subscription = change_feed.subscribe(principal['tenant_id'])
+    resume_from = request.headers.get('last-event-id') or last_event_id
+    backlog = change_feed.replay(resume_from, principal['tenant_id']) if resume_from else []
+    return StreamingResponse(
+        event_stream(request, subscription, backlog),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 # Dashboard routes
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
+    tenant_id = current_user['tenant_id']
     today = datetime.now(timezone.utc).date().isoformat()
-    
-    # Today's reservations
-    today_reservations = await db.reservations.count_documents({
-        'date': today,
-        'status': {'$ne': 'cancelled'}
-    })
+    return await dashboard_cache.get_or_compute((tenant_id, today), lambda: compute_dashboard_stats(tenant_id, today))
+
+async def compute_dashboard_stats(tenant_id: str, today: str):
+    # Today's totals and upcoming reservations in one aggregation; the HACCP
+    # count lives in another collection and runs concurrently
+    day = datetime.strptime(today, "%Y-%m-%d")
+    reservations_stats, haccp_today = await asyncio.gather(
+        db.reservations.aggregate([
+            {'$match': {'tenant_id': tenant_id, 'day': {'$gte': day}, 'status': {'$ne': 'cancelled'}}},
+            {'$facet': {
+                'today': [
+                    {'$match': {'day': day}},
+                    {'$group': {'_id': None, 'count': {'$sum': 1}, 'guests': {'$sum': '$guests'}}}
+                ],
+                'upcoming': [
+                    {'$sort': {'day': 1, 'start_minute': 1}},
+                    {'$limit': 5},
+                    {'$project': RESERVATION_PROJECTION}
+                ]
+            }}
+        ]).to_list(1),
+        db.haccp_records.count_documents({
+            'tenant_id': tenant_id,
+            'created_at': {'$gte': day.replace(tzinfo=timezone.utc)}
+        })
+    )
+    facets = reservations_stats[0] if reservations_stats else {'today': [], 'upcoming': []}
+    today_totals = facets['today'][0] if facets['today'] else {'count': 0, 'guests': 0}
     
     # Occupancy rate
-    settings = await db.settings.find_one({'settings_id': 'global'}, {'_id': 0})
+    snapshot = await tenant_settings(tenant_id).get()
+    settings = snapshot.data if snapshot else None
     total_capacity = (settings.get('max_capacity_lunch', 50) + settings.get('max_capacity_dinner', 60)) if settings else 110
-    
-    today_guests = await db.reservations.find({
-        'date': today,
-        'status': {'$ne': 'cancelled'}
-    }, {'_id': 0}).to_list(1000)
-    
-    total_guests = sum(r.get('guests', 0) for r in today_guests)
-    occupancy_rate = (total_guests / total_capacity * 100) if total_capacity > 0 else 0
-    
-    # Upcoming reservations
-    upcoming = await db.reservations.find({
-        'date': {'$gte': today},
-        'status': {'$ne': 'cancelled'}
-    }, {'_id': 0}).sort('date', 1).to_list(5)
+    occupancy_rate = (today_totals['guests'] / total_capacity * 100) if total_capacity > 0 else 0
     
     # HACCP alerts
-    haccp_today = await db.haccp_records.count_documents({
-        'created_at': {'$gte': today}
-    })
-    
     haccp_alerts = 0
     if haccp_today < 5:
         haccp_alerts = 5 - haccp_today
     
     return {
-        'today_reservations': today_reservations,
+        'today_reservations': today_totals['count'],
         'occupancy_rate': round(occupancy_rate, 1),
-        'upcoming_reservations': upcoming,
+        'upcoming_reservations': facets['upcoming'],
         'haccp_alerts': haccp_alerts,
         'pending_records': haccp_alerts
     }
 
+# Compression
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '5'))
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/csv', 'text/html')
+
+class GzipEncoder:
+    def __init__(self):
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        # Sync flush so every streamed chunk reaches the client right away
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+class BrotliEncoder:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=min(COMPRESSION_LEVEL, 11))
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+class ZstdEncoder:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+# Server preference when the client accepts several with the same q
+ENCODERS = {'br': BrotliEncoder, 'zstd': ZstdEncoder, 'gzip': GzipEncoder}
+if brotli is None:
+    del ENCODERS['br']
+if zstandard is None:
+    del ENCODERS['zstd']
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                continue
+        weights[name.strip()] = quality
+    candidates = [
+        (weights.get(name, weights.get('*', 0.0)), -rank, name)
+        for rank, name in enumerate(ENCODERS)
+    ]
+    quality, _, name = max(candidates)
+    return name if quality > 0 else None
+
+ETAG_CODING = re.compile(r'-(br|zstd|gzip)"$')
+
+def coded_etag(etag: str, encoding: str) -> str:
+    # Strong validators must differ between content-codings; weak ones
+    # may be shared and are left alone
+    if etag.startswith('"') and etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return etag
+
+def uncoded_validators(if_none_match: str) -> tuple:
+    # If-None-Match with the suffixes coded_etag added removed, so routes
+    # compare against their own tags, and the coding of the client's copy
+    coding = None
+    tags = []
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        match = ETAG_CODING.search(tag)
+        if match and not tag.startswith('W/'):
+            coding = match.group(1)
+            tag = tag[:match.start()] + '"'
+        tags.append(tag)
+    return ', '.join(tags), coding
+
+class CompressionStats:
+    def __init__(self):
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+compression_stats = {}
+
+class CompressionMiddleware:
+    # Compresses JSON/text responses with the best encoding the client
+    # accepts, once at least COMPRESSION_MIN_SIZE bytes are known to
+    # follow; smaller bodies go out untouched. Streamed bodies are
+    # compressed chunk by chunk with a flush after each, so NDJSON pages
+    # still arrive progressively. Event streams, partial responses and
+    # already-encoded bodies pass through.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = dict((k.lower(), v) for k, v in scope['headers'])
+        encoding = negotiate_encoding(headers.get(b'accept-encoding', b'').decode('latin-1'))
+        if_none_match, cached_coding = uncoded_validators(headers.get(b'if-none-match', b'').decode('latin-1'))
+        if cached_coding:
+            scope = dict(scope, headers=[
+                (k, if_none_match.encode('latin-1') if k.lower() == b'if-none-match' else v)
+                for k, v in scope['headers']
+            ])
+        if encoding is None and cached_coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        buffered = b''
+        encoder = None
+        stats = None
+
+        async def send_compressed(message):
+            nonlocal start_message, buffered, encoder, stats
+            if message['type'] == 'http.response.start':
+                response_headers = Headers(raw=message['headers'])
+                content_type = response_headers.get('content-type', '').split(';')[0].strip()
+                if message['status'] == 304 and cached_coding and 'etag' in response_headers:
+                    # The client's copy is the coded one, so is the validator
+                    MutableHeaders(raw=message['headers'])['etag'] = coded_etag(response_headers['etag'], cached_coding)
+                    await send(message)
+                elif (
+                    encoding is not None
+                    and message['status'] == 200
+                    and 'content-encoding' not in response_headers
+                    and content_type in COMPRESSIBLE_TYPES
+                ):
+                    start_message = message
+                else:
+                    await send(message)
+                return
+            if message['type'] != 'http.response.body' or (start_message is None and encoder is None):
+                await send(message)
+                return
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if start_message is not None:
+                # Hold the start until we know whether the body is worth it
+                buffered += body
+                if more_body and len(buffered) < COMPRESSION_MIN_SIZE:
+                    return
+                if len(buffered) < COMPRESSION_MIN_SIZE:
+                    await send(start_message)
+                    start_message = None
+                    await send({'type': 'http.response.body', 'body': buffered, 'more_body': False})
+                    return
+                encoder = ENCODERS[encoding]()
+                route = scope.get('route')
+                key = (scope['method'], route.path if route else 'unmatched')
+                if key not in compression_stats:
+                    compression_stats[key] = CompressionStats()
+                stats = compression_stats[key]
+                stats.responses += 1
+                mutable = MutableHeaders(raw=start_message['headers'])
+                del mutable['content-length']
+                mutable['content-encoding'] = encoding
+                mutable.add_vary_header('Accept-Encoding')
+                if 'etag' in mutable:
+                    mutable['etag'] = coded_etag(mutable['etag'], encoding)
+                await send(start_message)
+                start_message = None
+                body, buffered = buffered, b''
+            compressed = encoder.compress(body) if body else b''
+            if not more_body:
+                compressed += encoder.finish()
+            stats.bytes_in += len(body)
+            stats.bytes_out += len(compressed)
+            await send({'type': 'http.response.body', 'body': compressed, 'more_body': more_body})
+
+        await self.app(scope, receive, send_compressed)
+
+def compression_metrics_lines() -> List[str]:
+    # One block per family, as in route_metrics_lines
+    routes = [(f'method="{method}",route="{route}"', stats) for (method, route), stats in sorted(compression_stats.items())]
+    lines = ['# TYPE http_compressed_responses_total counter']
+    for labels, stats in routes:
+        lines.append(f'http_compressed_responses_total{{{labels}}} {stats.responses}')
+    lines.append('# TYPE http_response_bytes_total counter')
+    for labels, stats in routes:
+        lines.append(f'http_response_bytes_total{{{labels},stage="uncompressed"}} {stats.bytes_in}')
+        lines.append(f'http_response_bytes_total{{{labels},stage="compressed"}} {stats.bytes_out}')
+    lines.append('# TYPE http_compression_ratio gauge')
+    for labels, stats in routes:
+        if stats.bytes_out:
+            lines.append(f'http_compression_ratio{{{labels}}} {round(stats.bytes_in / stats.bytes_out, 2)}')
+    return lines
+
+# Metrics routes
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    metrics = RequestMetrics()
+    token = current_request.set(metrics)
+    started = monotonic()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        current_request.reset(token)
+        route = request.scope.get('route')
+        key = (request.method, route.path if route else 'unmatched')
+        if key not in route_stats:
+            route_stats[key] = RouteStats()
+        route_stats[key].observe(status_code, monotonic() - started, metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    lines = route_metrics_lines() + compression_metrics_lines() + rate_limiter.metrics_lines()
+    lines.append('# TYPE password_duration_seconds histogram')
+    for operation, stats in password_pool.stats.items():
+        lines.extend(stats.prometheus('password_duration_seconds', f'operation="{operation}"'))
+    lines.append('# TYPE password_pending gauge')
+    lines.append(f'password_pending {password_pool.pending}')
+    lines.append('# TYPE password_rejected_total counter')
+    lines.append(f'password_rejected_total {password_pool.rejected}')
+    lines.append('# TYPE image_processing_duration_seconds histogram')
+    lines.extend(image_pipeline.latency.prometheus('image_processing_duration_seconds', ''))
+    lines.append('# TYPE image_processing_failures_total counter')
+    lines.append(f'image_processing_failures_total {image_pipeline.failures}')
+    return PlainTextResponse('\n'.join(lines) + '\n', media_type='text/plain; version=0.0.4')
+
 # Include router
 app.include_router(api_router)
 
+app.add_middleware(CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
+@app.on_event("startup")
+async def startup_db_client():
+    await migrate_tenancy()
+    await ensure_indexes()
+    await register_tenants()
+    # Quick once converted; run migrate_dates.py first on large databases
+    await run_date_migrations()
+    await backfill_table_claims()
+    await backfill_temperature_buckets()
+    if os.environ.get('VERIFY_QUERY_PLANS') == '1':
+        await verify_query_plans()
+    email_outbox.start()
+    haccp_alerts.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await email_outbox.stop()
+    await haccp_alerts.stop()
     client.close()
+    password_pool.executor.shutdown(wait=False)
+    image_pipeline.shutdown()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / 'backend'
+# Latencies depend on the host, so the baseline is recorded locally with
+# --save-baseline and never committed
+DEFAULT_BASELINE = Path(__file__).parent / 'test_reports' / 'benchmark_baseline.json'
+
+# Routes whose p95 is checked against the baseline
+WATCHED_ROUTES = ['POST /api/reservations', 'GET /api/dashboard/stats']
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+class RestaurantBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.server = None
+        self.client = None
+        self.headers = {}
+        self.samples = {}
+        self.windows = {}
+        self.errors = {}
+        self.date = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
+
+    def log(self, message):
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}")
+
+    def load_app(self):
+        # Imported here so MONGO_URL/DB_NAME can be set first
+        os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+        os.environ.setdefault('DB_NAME', f'benchmark_{os.getpid()}')
+        # Every simulated guest shares one client IP here
+        os.environ.setdefault('BOOKING_IP_BURST', '1000000')
+        sys.path.insert(0, str(BACKEND_DIR))
+        import server
+        if self.args.mongo == 'mock':
+            from mongomock_motor import AsyncMongoMockClient
+            server.client = AsyncMongoMockClient()
+            server.db = server.client[os.environ['DB_NAME']]
+        self.server = server
+
+    async def request(self, route, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, headers=self.headers, **kwargs)
+            failed = response.status_code >= 500
+        except httpx.HTTPError:
+            response, failed = None, True
+        finished = time.perf_counter()
+        self.samples.setdefault(route, []).append(finished - started)
+        self.windows[route] = (self.windows.get(route, (started,))[0], finished)
+        if failed:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return response
+
+    async def setup(self):
+        response = await self.client.post('/api/auth/register', json={
+            'name': 'Benchmark', 'email': f'bench{os.getpid()}@example.com', 'password': 'benchmark'
+        })
+        self.headers = {'Authorization': f"Bearer {response.json()['token']}"}
+        await self.client.get('/api/settings')
+        await self.client.put('/api/settings', headers=self.headers, json={
+            'open_days': list(range(7)),
+            'lunch_start': '12:00', 'lunch_end': '15:00',
+            'dinner_start': '19:00', 'dinner_end': '23:00',
+            'avg_table_time': 90,
+            'max_capacity_lunch': 10 * self.args.tables,
+            'max_capacity_dinner': 10 * self.args.tables
+        })
+        room = (await self.client.post('/api/rooms', headers=self.headers, json={'name': 'Sala', 'capacity': 200})).json()
+        for number in range(1, self.args.tables + 1):
+            await self.client.post('/api/tables', headers=self.headers, json={
+                'number': str(number), 'room_id': room['room_id'],
+                'capacity': random.choice([2, 2, 4, 4, 6]), 'can_join': number % 3 == 0
+            })
+
+    async def dinner_rush(self):
+        # Burst of public bookings for one dinner service
+        queue = asyncio.Queue()
+        for n in range(self.args.bookings):
+            queue.put_nowait(n)
+        times = [f'{hour}:{minute:02d}' for hour in (19, 20, 21) for minute in (0, 15, 30, 45)]
+
+        async def worker():
+            while not queue.empty():
+                n = queue.get_nowait()
+                await self.request('POST /api/reservations', 'POST', '/api/reservations', json={
+                    'name': f'Cliente {n}', 'phone': f'9{n:08d}',
+                    'guests': random.choice([2, 2, 2, 3, 4, 4, 5, 6]),
+                    'date': self.date, 'time': random.choice(times)
+                })
+
+        await asyncio.gather(*[worker() for _ in range(self.args.concurrency)])
+
+    async def dashboard_polling(self, stop):
+        while not stop.is_set():
+            await self.request('GET /api/dashboard/stats', 'GET', '/api/dashboard/stats')
+            await self.request('GET /api/reservations', 'GET', '/api/reservations', params={'date': self.date})
+            await asyncio.sleep(self.args.poll_interval)
+
+    async def haccp_logging(self, stop):
+        while not stop.is_set():
+            await self.request('POST /api/haccp', 'POST', '/api/haccp', json={
+                'record_type': 'temperature', 'equipment_product': 'Camara 1',
+                'value': f'{random.uniform(1, 5):.1f}', 'user_name': 'Benchmark'
+            })
+            await self.request('GET /api/haccp', 'GET', '/api/haccp')
+            await asyncio.sleep(self.args.poll_interval)
+
+    async def run(self):
+        self.load_app()
+        await self.server.startup_db_client()
+        transport = httpx.ASGITransport(app=self.server.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+                self.client = client
+                await self.setup()
+                self.log(f"Running {self.args.bookings} bookings with concurrency {self.args.concurrency}...")
+                stop = asyncio.Event()
+                background = [
+                    asyncio.create_task(self.dashboard_polling(stop)),
+                    asyncio.create_task(self.haccp_logging(stop)),
+                ]
+                started = time.perf_counter()
+                await self.dinner_rush()
+                self.log(f"Bookings done in {time.perf_counter() - started:.1f}s")
+                # Pollers keep going for the whole run so their percentiles
+                # rest on enough samples
+                await asyncio.sleep(max(0.0, self.args.duration - (time.perf_counter() - started)))
+                elapsed = time.perf_counter() - started
+                stop.set()
+                await asyncio.gather(*background)
+        finally:
+            await self.server.shutdown_db_client()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        results = {}
+        for route, samples in sorted(self.samples.items()):
+            first, last = self.windows[route]
+            results[route] = {
+                'count': len(samples),
+                'errors': self.errors.get(route, 0),
+                'throughput': round(len(samples) / max(last - first, 1e-9), 1),
+                'p50_ms': round(percentile(samples, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(samples, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+            }
+        self.log(f"\n📊 Benchmark Results ({elapsed:.1f}s):")
+        self.log(f"   {'route':<28} {'count':>6} {'err':>4} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for route, stats in results.items():
+            self.log(
+                f"   {route:<28} {stats['count']:>6} {stats['errors']:>4} {stats['throughput']:>7}"
+                f" {stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8}"
+            )
+        return results
+
+def serialization_benchmark(rows, repeat):
+    # Per-1000-row cost of turning Mongo documents into a list response:
+    # response_model validation + stdlib JSON (before) against the
+    # precompiled serializer + FastJSONResponse (after)
+    os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+    os.environ.setdefault('DB_NAME', 'benchmark')
+    sys.path.insert(0, str(BACKEND_DIR))
+    from typing import List
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+    import server
+
+    now = datetime.now()
+    samples = {
+        'Reservation': (server.Reservation, frozenset(), [{
+            'reservation_id': f'r{n}', 'tenant_id': 'default', 'name': f'Cliente {n}', 'phone': f'9{n:08d}',
+            'email': None, 'guests': 2 + n % 5, 'date': '2026-05-01', 'time': '20:00', 'meal_type': 'jantar',
+            'table_id': f't{n % 40}', 'table_ids': [f't{n % 40}'], 'duration': 90, 'status': 'confirmed',
+            'notes': None, 'created_at': now
+        } for n in range(rows)]),
+        'HACCPRecord': (server.HACCPRecord, frozenset(server.HACCP_LIST_PROJECTION), [{
+            'record_id': f'h{n}', 'tenant_id': 'default', 'record_type': 'temperature',
+            'equipment_product': f'Camara {n % 4}', 'value': '3.5', 'numeric_value': 3.5,
+            'photo_url': None, 'photo_thumbnail': None, 'user_name': 'Benchmark',
+            'signature_thumbnail': None, 'notes': None, 'created_at': now
+        } for n in range(rows)]),
+    }
+
+    async def measure():
+        results = {}
+        for name, (model, exclude, documents) in samples.items():
+            field = create_response_field(name=name, type_=List[model])
+            serializer = server.model_serializer(model, exclude)
+
+            async def before():
+                content = await serialize_response(field=field, response_content=documents)
+                return JSONResponse(content).body
+
+            async def after():
+                return server.FastJSONResponse([serializer.dump(d) for d in documents]).body
+
+            timings = {}
+            for label, render in (('before', before), ('after', after)):
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    body = await render()
+                timings[label] = (time.perf_counter() - started) / repeat / rows * 1000 * 1000
+                timings[f'{label}_body'] = body
+            if json.loads(timings.pop('before_body')) != json.loads(timings.pop('after_body')):
+                raise AssertionError(f"{name}: serializer output differs from response_model output")
+            results[name] = timings
+        return results
+
+    return asyncio.run(measure())
+
+def compare(results, baseline, tolerance, min_samples):
+    regressions = []
+    for route in WATCHED_ROUTES:
+        if route not in results or route not in baseline:
+            continue
+        # A p95 of a handful of requests is mostly noise
+        count = min(results[route]['count'], baseline[route]['count'])
+        if count < min_samples:
+            regressions.append(f"{route}: only {count} samples, need {min_samples} (raise --duration)")
+            continue
+        limit = baseline[route]['p95_ms'] * (1 + tolerance)
+        if results[route]['p95_ms'] > limit:
+            regressions.append(f"{route}: p95 {results[route]['p95_ms']}ms > {limit:.2f}ms")
+        if results[route]['errors'] > baseline[route].get('errors', 0):
+            regressions.append(f"{route}: {results[route]['errors']} server errors")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='In-process load test of the booking and admin APIs')
+    parser.add_argument('--mongo', choices=['mock', 'url'], default='mock',
+                        help='mock uses mongomock-motor; url uses MONGO_URL')
+    parser.add_argument('--bookings', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--tables', type=int, default=40)
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help='seconds the dashboard and HACCP pollers run, at least the booking burst')
+    parser.add_argument('--min-samples', type=int, default=100,
+                        help='samples a watched route needs before its p95 is compared')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p95 slowdown against the baseline')
+    parser.add_argument('--serialization', action='store_true',
+                        help='only run the list serialization microbenchmark')
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.serialization:
+        for name, timings in serialization_benchmark(args.rows, repeat=20).items():
+            print(f"{name:<12} before {timings['before']:7.2f} ms/1000 rows   "
+                  f"after {timings['after']:7.2f} ms/1000 rows   "
+                  f"{timings['before'] / timings['after']:5.1f}x")
+        return 0
+
+    benchmark = RestaurantBenchmark(args)
+    results = asyncio.run(benchmark.run())
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(results, indent=2))
+        benchmark.log(f"Baseline saved to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        benchmark.log("No baseline found, run with --save-baseline first")
+        return 0
+    regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance, args.min_samples)
+    for regression in regressions:
+        benchmark.log(f"❌ {regression}")
+    if regressions:
+        return 1
+    benchmark.log("✅ No regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
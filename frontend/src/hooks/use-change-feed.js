@@ -0,0 +1,59 @@
+import { useEffect, useRef } from 'react';
+import axios from 'axios';
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+const API = `${BACKEND_URL}/api`;
+
+// Subscribes to /api/events with a short-lived stream ticket in the URL,
+// never the session token. A ticket only opens the stream, so once the
+// browser gives up reconnecting with an expired one, a new ticket is
+// fetched and the stream resumes from the last event seen.
+export function useChangeFeed(handlers) {
+  const handlersRef = useRef(handlers);
+  handlersRef.current = handlers;
+
+  useEffect(() => {
+    if (!localStorage.getItem('token')) return undefined;
+
+    let source = null;
+    let retry = null;
+    let closed = false;
+    let lastEventId = null;
+
+    const open = async () => {
+      let ticket;
+      try {
+        const response = await axios.post(`${API}/events/ticket`);
+        ticket = response.data.ticket;
+      } catch (error) {
+        if (error.response?.status !== 401 && !closed) {
+          retry = setTimeout(open, 5000);
+        }
+        return;
+      }
+      if (closed) return;
+
+      const params = new URLSearchParams({ ticket });
+      if (lastEventId) params.set('last_event_id', lastEventId);
+      source = new EventSource(`${API}/events?${params}`);
+      Object.keys(handlersRef.current).forEach(type =>
+        source.addEventListener(type, (event) => {
+          if (event.lastEventId) lastEventId = event.lastEventId;
+          handlersRef.current[type](event);
+        })
+      );
+      source.onerror = () => {
+        if (source.readyState === EventSource.CLOSED && !closed) {
+          retry = setTimeout(open, 1000);
+        }
+      };
+    };
+
+    open();
+    return () => {
+      closed = true;
+      clearTimeout(retry);
+      if (source) source.close();
+    };
+  }, []);
+}
@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react';
 import axios from 'axios';
 import { useTranslation } from 'react-i18next';
 import { AdminLayout } from '../components/AdminLayout';
+import { useChangeFeed } from '../hooks/use-change-feed';
 import { Card } from '../components/ui/card';
 import { Calendar, Users, AlertTriangle, TrendingUp } from 'lucide-react';
 import { motion } from 'framer-motion';
@@ -29,6 +30,10 @@ export const AdminDashboard = () => {
     }
   };
 
+  useChangeFeed(Object.fromEntries(
+    ['reservation.created', 'reservation.updated', 'reservation.cancelled', 'haccp.created', 'reset'].map(type => [type, fetchStats])
+  ));
+
   const statCards = [
     {
       title: t('dashboard.todayReservations'),
@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import axios from 'axios';
 import { AdminLayout } from '../components/AdminLayout';
+import { useChangeFeed } from '../hooks/use-change-feed';
 import { Button } from '../components/ui/button';
 import { Card } from '../components/ui/card';
 import { Input } from '../components/ui/input';
@@ -39,6 +40,25 @@ export const AdminReservations = () => {
     }
   };
 
+  const applyChange = (event) => {
+    const change = JSON.parse(event.data);
+    setReservations(prev => {
+      const index = prev.findIndex(r => r.reservation_id === change.reservation_id);
+      if (index === -1) return [change, ...prev];
+      const next = [...prev];
+      next[index] = { ...prev[index], ...change };
+      return next;
+    });
+  };
+
+  // Resumes from the last event id after every reconnect
+  useChangeFeed({
+    'reservation.created': applyChange,
+    'reservation.updated': applyChange,
+    'reservation.cancelled': applyChange,
+    'reset': fetchReservations
+  });
+
   const filterReservations = () => {
     let filtered = [...reservations];
 
@@ -0,0 +1,95 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test_database')
+# Tests book many times from one client
+os.environ.setdefault('BOOKING_IP_BURST', '1000000')
+os.environ.setdefault('BOOKING_CONTACT_BURST', '1000000')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import mongomock.collection
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+import server
+
+# pymongo 4.9+ passes sort= to bulk updates, which mongomock does not accept yet
+_add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+def add_update(self, *args, sort=None, **kwargs):
+    return _add_update(self, *args, **kwargs)
+
+mongomock.collection.BulkOperationBuilder.add_update = add_update
+
+server.client = AsyncMongoMockClient()
+server.db = server.client['test_database']
+
+@pytest.fixture(scope='session')
+def app_client():
+    with TestClient(server.app) as client:
+        yield client
+
+@pytest.fixture
+def api(app_client):
+    # Every test gets an empty database and cold in-memory caches
+    server.db = server.client[f"test_{os.urandom(4).hex()}"]
+    server.settings_caches.clear()
+    server.table_layouts.clear()
+    server.tenant_registry.known.clear()
+    server.reference_versions.versions.clear()
+    server.principal_cache.clear()
+    server.principal_cache.revocations = 0
+    server.principal_cache.synced_at = float('-inf')
+    server.dashboard_cache.invalidate()
+    app_client.portal.call(server.ensure_indexes)
+    app_client.portal.call(server.register_tenants)
+    yield app_client
+    app_client.portal.call(server.client.drop_database, server.db.name)
+
+@pytest.fixture
+def run(api):
+    # Runs a coroutine function on the app's event loop
+    def call(func, *args):
+        return api.portal.call(func, *args)
+    return call
+
+@pytest.fixture
+def admin(api):
+    response = api.post('/api/auth/register', json={'name': 'Admin', 'email': 'admin@example.com', 'password': 'secret123'})
+    assert response.status_code == 200
+    return {'Authorization': f"Bearer {response.json()['token']}"}
+
+@pytest.fixture
+def configure(api, admin):
+    # Open every day so test dates never land on a closed day
+    def update(**overrides):
+        settings = api.get('/api/settings').json()
+        for key in ('settings_id', 'tenant_id'):
+            settings.pop(key, None)
+        settings.update({'open_days': list(range(7)), **overrides})
+        response = api.put('/api/settings', json=settings, headers=admin)
+        assert response.status_code == 200
+        return response.json()
+    update()
+    return update
+
+@pytest.fixture
+def add_tables(api, admin):
+    def create(*capacities, can_join=False):
+        room = api.post('/api/rooms', json={'name': 'Sala', 'capacity': 100}, headers=admin).json()
+        tables = []
+        for number, capacity in enumerate(capacities, 1):
+            response = api.post('/api/tables', json={
+                'number': str(number),
+                'room_id': room['room_id'],
+                'capacity': capacity,
+                'can_join': can_join
+            }, headers=admin)
+            assert response.status_code == 200
+            tables.append(response.json()['table_id'])
+        return tables
+    return create
@@ -0,0 +1,48 @@
+import hashlib
+
+import pytest
+
+import server
+
+@pytest.fixture
+def blob_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(server.blob_store, 'root', tmp_path)
+    monkeypatch.setattr(server, 'BLOB_MAX_SIZE', 1024)
+    monkeypatch.setattr(server, 'BLOB_MULTIPART_OVERHEAD', 512)
+    return tmp_path
+
+def stored_files(root):
+    return sorted(path.name for path in root.rglob('*') if path.is_file())
+
+def test_upload_is_stored_under_its_hash(api, admin, blob_dir):
+    data = b'x' * 1000
+    response = api.post('/api/blobs', files={'file': ('menu.txt', data, 'text/plain')}, data={'note': 'menu'}, headers=admin)
+    assert response.status_code == 200
+    blob = response.json()
+    assert blob['blob_id'] == hashlib.sha256(data).hexdigest()
+    assert (blob['size'], blob['content_type']) == (1000, 'text/plain')
+    assert stored_files(blob_dir) == [blob['blob_id']]
+
+def test_oversized_upload_is_rejected(api, admin, blob_dir):
+    response = api.post('/api/blobs', files={'file': ('menu.txt', b'x' * 1025, 'text/plain')}, headers=admin)
+    assert response.status_code == 413
+    assert stored_files(blob_dir) == []
+
+def chunked(*chunks):
+    yield from chunks
+
+def test_declared_length_is_rejected_before_reading(api, admin, blob_dir):
+    headers = {**admin, 'Content-Type': 'multipart/form-data; boundary=b', 'Content-Length': '4096'}
+    response = api.post('/api/blobs', content=chunked(b'x' * 4096), headers=headers)
+    assert response.status_code == 413
+
+def test_body_without_length_is_capped_while_read(api, admin, blob_dir):
+    part = b'--b\r\nContent-Disposition: form-data; name="note"\r\n\r\n'
+    headers = {**admin, 'Content-Type': 'multipart/form-data; boundary=b'}
+    response = api.post('/api/blobs', content=chunked(part, *[b'x' * 1000] * 3), headers=headers)
+    assert response.status_code == 413
+    assert stored_files(blob_dir) == []
+
+def test_missing_file_field(api, admin, blob_dir):
+    response = api.post('/api/blobs', files={'photo': ('menu.txt', b'x', 'text/plain')}, headers=admin)
+    assert response.status_code == 400
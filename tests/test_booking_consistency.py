@@ -0,0 +1,103 @@
+import pytest
+
+import server
+
+DATE = '2030-11-06'
+
+def book(api, time, guests=2, date=DATE):
+    return api.post('/api/reservations', json={'name': 'Ana', 'phone': '912345678', 'guests': guests, 'date': date, 'time': time})
+
+def claims(run, reservation_id):
+    async def fetch():
+        cursor = server.db.table_claims.find({'reservation_id': reservation_id}, {'_id': 0})
+        return sorted((c['table_id'], c['slot'], c['start'], c['end']) for c in await cursor.to_list(None))
+    return run(fetch)
+
+def booked_guests(run, meal_type=server.MealType.dinner, date=DATE):
+    counter = run(server.db.service_capacity.find_one, {'tenant_id': server.DEFAULT_TENANT, 'date': date, 'meal_type': meal_type.value})
+    return counter['guests'] if counter else 0
+
+def test_back_to_back_bookings_share_a_table(api, configure, add_tables):
+    configure(avg_table_time=90)
+    small, large = add_tables(4, 8)
+    first = book(api, '19:10')
+    second = book(api, '20:40')
+    overlapping = book(api, '19:30')
+    assert [r.status_code for r in (first, second, overlapping)] == [200, 200, 200]
+    assert first.json()['table_ids'] == [small]
+    assert second.json()['table_ids'] == [small]
+    assert overlapping.json()['table_ids'] == [large]
+
+def test_losing_claim_writes_nothing(run):
+    assert run(server.claim_tables, 'a', DATE, ['t1'], 1150, 1240)
+    # Overlaps a partly covered slot of 'a'
+    assert not run(server.claim_tables, 'b', DATE, ['t1'], 1235, 1300)
+    assert run(server.claim_tables, 'c', DATE, ['t1'], 1240, 1300)
+    # Overlaps a fully covered slot of 'a'
+    assert not run(server.claim_tables, 'd', DATE, ['t1'], 1160, 1200)
+    assert claims(run, 'b') == []
+    assert claims(run, 'd') == []
+    assert claims(run, 'a') and claims(run, 'c')
+
+def test_capacity_is_never_oversold(api, run, configure):
+    configure(max_capacity_dinner=6)
+    assert book(api, '20:00', guests=4).status_code == 200
+    rejected = book(api, '20:00', guests=4)
+    assert rejected.status_code == 400
+    assert rejected.json()['detail'] == "No capacity available for this time"
+    assert book(api, '21:00', guests=2).status_code == 200
+    assert booked_guests(run) == 6
+
+def test_failed_insert_releases_claims_and_capacity(api, run, configure, add_tables, monkeypatch):
+    configure()
+    add_tables(4)
+
+    def fail(date, time):
+        raise RuntimeError("insert failed")
+
+    monkeypatch.setattr(server, 'reservation_schedule', fail)
+    with pytest.raises(RuntimeError):
+        book(api, '20:00', guests=3)
+    assert run(server.db.table_claims.count_documents, {}) == 0
+    assert booked_guests(run) == 0
+
+def test_invalid_update_keeps_claims(api, run, admin, configure, add_tables):
+    configure()
+    add_tables(4)
+    reservation = book(api, '20:00').json()
+    before = claims(run, reservation['reservation_id'])
+    assert before
+    for change in ({'time': '25:99'}, {'date': '2030-13-40'}):
+        response = api.put(f"/api/reservations/{reservation['reservation_id']}", json=change, headers=admin)
+        assert response.status_code == 400
+        assert claims(run, reservation['reservation_id']) == before
+
+def test_conflicting_move_restores_original_claims(api, run, admin, configure, add_tables):
+    configure(avg_table_time=90)
+    add_tables(4)
+    book(api, '19:00')
+    later = book(api, '21:00').json()
+    before = claims(run, later['reservation_id'])
+    response = api.put(f"/api/reservations/{later['reservation_id']}", json={'time': '19:30'}, headers=admin)
+    assert response.status_code == 409
+    assert claims(run, later['reservation_id']) == before
+
+def test_move_to_lunch_moves_guests_between_counters(api, run, admin, configure):
+    configure()
+    reservation = book(api, '20:00', guests=3).json()
+    assert booked_guests(run) == 3
+    response = api.put(f"/api/reservations/{reservation['reservation_id']}", json={'time': '13:00'}, headers=admin)
+    assert response.status_code == 200
+    assert response.json()['meal_type'] == server.MealType.lunch.value
+    assert booked_guests(run, server.MealType.dinner) == 0
+    assert booked_guests(run, server.MealType.lunch) == 3
+
+def test_cancel_releases_claims_and_capacity(api, run, admin, configure, add_tables):
+    configure()
+    add_tables(4)
+    reservation = book(api, '20:00', guests=3).json()
+    assert booked_guests(run) == 3
+    response = api.put(f"/api/reservations/{reservation['reservation_id']}", json={'status': 'cancelled'}, headers=admin)
+    assert response.status_code == 200
+    assert claims(run, reservation['reservation_id']) == []
+    assert booked_guests(run) == 0
@@ -0,0 +1,93 @@
+import json
+
+import server
+
+DATE = '2030-11-06'
+
+def row(time='20:00', guests=2, **fields):
+    return {'name': 'Ana', 'phone': '912345678', 'guests': guests, 'date': DATE, 'time': time, **fields}
+
+def import_rows(api, headers, *rows):
+    response = api.post('/api/reservations/bulk', content='\n'.join(json.dumps(r) for r in rows), headers=headers)
+    assert response.status_code == 200
+    return response.json()['results']
+
+def claim_count(run, reservation_id):
+    return run(server.db.table_claims.count_documents, {'reservation_id': reservation_id})
+
+def booked_guests(run, tenant_id=server.DEFAULT_TENANT):
+    counter = run(server.db.service_capacity.find_one, {'tenant_id': tenant_id, 'date': DATE, 'meal_type': server.MealType.dinner.value})
+    return counter['guests'] if counter else 0
+
+def test_rows_are_seated_like_single_bookings(api, admin, configure, add_tables):
+    configure(avg_table_time=90)
+    small, large = add_tables(4, 8)
+    results = import_rows(api, admin, row('19:10'), row('20:40'), row('19:30'))
+    assert [r['status'] for r in results] == ['created'] * 3
+    assert [r['table_id'] for r in results] == [small, small, large]
+
+def test_rows_admitted_in_file_order_until_full(api, run, admin, configure):
+    configure(max_capacity_dinner=6)
+    results = import_rows(api, admin, row(guests=4), row(guests=4), row(guests=2))
+    assert [r['status'] for r in results] == ['created', 'error', 'created']
+    assert results[1]['detail'] == "No capacity available for this time"
+    assert booked_guests(run) == 6
+
+def test_duplicate_id_in_one_import(api, run, admin, configure, add_tables):
+    configure()
+    add_tables(4, 4)
+    results = import_rows(api, admin, row(reservation_id='dup'), row(reservation_id='dup'))
+    assert results[0]['status'] == 'created'
+    assert results[1] == {'row': 1, 'status': 'error', 'detail': "Duplicate reservation_id in this import"}
+    assert claim_count(run, 'dup') > 0
+    assert booked_guests(run) == 2
+
+def test_id_of_another_tenant_is_rejected(api, run, admin, configure, add_tables):
+    configure()
+    add_tables(4)
+    import_rows(api, admin, row(reservation_id='shared'))
+    claims = claim_count(run, 'shared')
+
+    response = api.post('/api/auth/register', json={'name': 'Rui', 'email': 'rui@example.com', 'password': 'secret123'})
+    other_tenant = response.json()['user']['tenant_id']
+    other = {'Authorization': f"Bearer {response.json()['token']}"}
+    settings = api.get(f'/api/settings?tenant={other_tenant}').json()
+    settings['open_days'] = list(range(7))
+    assert api.put('/api/settings', json=settings, headers=other).status_code == 200
+
+    results = import_rows(api, other, row(reservation_id='shared', name='Rui'))
+    assert results[0] == {'row': 0, 'status': 'error', 'detail': "reservation_id is already in use"}
+    assert claim_count(run, 'shared') == claims
+    reservation = run(server.db.reservations.find_one, {'reservation_id': 'shared'})
+    assert (reservation['tenant_id'], reservation['name']) == (server.DEFAULT_TENANT, 'Ana')
+    assert booked_guests(run, other_tenant) == 0
+
+def test_existing_row_updates_contact_only(api, run, admin, configure):
+    configure()
+    import_rows(api, admin, row(reservation_id='r1'))
+    results = import_rows(api, admin, row(reservation_id='r1', name='Rita'))
+    assert results[0]['status'] == 'updated'
+    results = import_rows(api, admin, row(reservation_id='r1', guests=3))
+    assert results[0]['detail'] == "Date, time or guests changed; use PUT to move a reservation"
+    assert run(server.db.reservations.find_one, {'reservation_id': 'r1'})['name'] == 'Rita'
+    assert booked_guests(run) == 2
+
+def test_failed_insert_releases_only_that_rows_claims(api, run, admin, configure, add_tables, monkeypatch):
+    configure()
+    add_tables(4, 4)
+    collection_type = type(server.db.reservations)
+    insert_one, insert_many = collection_type.insert_one, collection_type.insert_many
+
+    async def racing_insert_many(self, documents, **kwargs):
+        # Another request stores 'taken' between the id lookup and the insert
+        if self.name == 'reservations':
+            await insert_one(self, {'reservation_id': 'taken', 'tenant_id': server.DEFAULT_TENANT})
+        return await insert_many(self, documents, **kwargs)
+
+    monkeypatch.setattr(collection_type, 'insert_many', racing_insert_many)
+    results = import_rows(api, admin, row(reservation_id='taken'), row(reservation_id='kept'))
+    assert results[0] == {'row': 0, 'status': 'error', 'detail': "Reservation already exists"}
+    assert results[1]['status'] == 'created'
+    assert claim_count(run, 'taken') == 0
+    assert claim_count(run, 'kept') > 0
+    assert booked_guests(run) == 2
@@ -0,0 +1,35 @@
+import pytest
+
+import server
+
+@pytest.fixture
+def ticket(api, admin):
+    response = api.post('/api/events/ticket', headers=admin)
+    assert response.status_code == 200
+    assert response.json()['expires_in'] == server.STREAM_TICKET_SECONDS
+    return response.json()['ticket']
+
+def test_ticket_authorizes_the_stream(run, ticket):
+    principal = run(server.authenticate_token, ticket, 'events')
+    assert principal['tenant_id'] == server.DEFAULT_TENANT
+
+def test_ticket_is_not_a_session_token(api, ticket):
+    response = api.get('/api/reservations', headers={'Authorization': f'Bearer {ticket}'})
+    assert response.status_code == 401
+
+def test_session_token_is_not_accepted_in_the_url(api, admin):
+    token = admin['Authorization'][7:]
+    assert api.get(f'/api/events?ticket={token}').status_code == 401
+    assert api.get(f'/api/events?token={token}').status_code == 401
+
+def test_expired_ticket_is_rejected(api, admin, monkeypatch):
+    monkeypatch.setattr(server, 'STREAM_TICKET_SECONDS', -1)
+    ticket = api.post('/api/events/ticket', headers=admin).json()['ticket']
+    response = api.get(f'/api/events?ticket={ticket}')
+    assert (response.status_code, response.json()['detail']) == (401, "Token expired")
+
+def test_revoked_session_revokes_its_tickets(api, admin, ticket):
+    user_id = api.get('/api/auth/me', headers=admin).json()['user_id']
+    assert api.post(f'/api/auth/users/{user_id}/revoke', headers=admin).status_code == 200
+    response = api.get(f'/api/events?ticket={ticket}')
+    assert (response.status_code, response.json()['detail']) == (401, "Session revoked")
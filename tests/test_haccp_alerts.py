@@ -0,0 +1,26 @@
+from datetime import datetime, timezone
+
+import server
+
+def test_missing_records_are_pending_during_the_window(api, admin):
+    alerts = api.get('/api/haccp/alerts', headers=admin).json()['alerts']
+    assert {alert['rule_id'] for alert in alerts} == {'temperature-daily', 'cleaning-daily'}
+
+def test_count_rule_is_due_from_the_last_minute(run):
+    rule = server.HACCPRule(**server.DEFAULT_HACCP_RULES[0])
+    midday = run(server.evaluate_rule, server.DEFAULT_TENANT, rule, datetime(2030, 11, 6, 12, 0, tzinfo=timezone.utc))
+    closing = run(server.evaluate_rule, server.DEFAULT_TENANT, rule, datetime(2030, 11, 6, 23, 59, tzinfo=timezone.utc))
+    assert (midday['count'], midday['due']) == (0, False)
+    assert (closing['count'], closing['due']) == (0, True)
+
+def test_only_due_alerts_are_emailed(run, monkeypatch):
+    notified = []
+
+    async def notify(tenant_id, day, alerts, transitions):
+        notified.extend(alert['rule_id'] for alert in alerts)
+
+    monkeypatch.setattr(server, 'notify_haccp_alerts', notify)
+    state = run(server.evaluate_haccp_alerts, server.DEFAULT_TENANT)
+    due = [alert['rule_id'] for alert in state['alerts'] if alert['due'] and alert['priority'] == 'high']
+    assert len(state['alerts']) == 2
+    assert notified == due
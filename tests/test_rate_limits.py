@@ -0,0 +1,22 @@
+import uuid
+
+import server
+
+def test_booking_flood_is_limited_before_the_tenant_lookup(api, monkeypatch):
+    monkeypatch.setattr(server, 'BOOKING_IP_LIMIT', (3, 0.01))
+    monkeypatch.setattr(server, 'TRUSTED_PROXY_COUNT', 1)
+    lookups = []
+    exists = server.tenant_registry.exists
+
+    async def counted_exists(tenant_id):
+        lookups.append(tenant_id)
+        return await exists(tenant_id)
+
+    monkeypatch.setattr(server.tenant_registry, 'exists', counted_exists)
+    body = {'name': 'Ana', 'phone': '912345678', 'guests': 2, 'date': '2030-11-06', 'time': '20:00'}
+    statuses = [
+        api.post('/api/reservations', json=body, headers={'X-Tenant-ID': uuid.uuid4().hex, 'X-Forwarded-For': '203.0.113.7'}).status_code
+        for _ in range(20)
+    ]
+    assert statuses == [404] * 3 + [429] * 17
+    assert len(lookups) == 3
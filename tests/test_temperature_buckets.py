@@ -0,0 +1,41 @@
+from datetime import datetime, timezone
+
+import server
+
+def reading(number, value):
+    return {
+        'record_id': f'r{number}',
+        'tenant_id': server.DEFAULT_TENANT,
+        'record_type': server.HACCPType.temperature.value,
+        'equipment_product': 'Camara 1',
+        'value': value,
+        'created_at': datetime(2030, 11, 6, 10, number, tzinfo=timezone.utc),
+        'user_name': 'Ana'
+    }
+
+def bucket(run):
+    return run(server.db.temperature_buckets.find_one, {'equipment_product': 'Camara 1'})
+
+def test_backfill_resumes_after_an_interruption(run, monkeypatch):
+    monkeypatch.setattr(server, 'TEMPERATURE_BACKFILL_BATCH', 2)
+    records = [reading(number, value) for number, value in enumerate(['3', '4,5', '-1', '2'])]
+    run(server.db.haccp_records.insert_many, records)
+    # The first batch was written before the process stopped
+    first = sorted(run(server.db.haccp_records.distinct, '_id'))[1]
+    for record in records[:2]:
+        run(server.record_temperature, {**record, 'numeric_value': server.parse_reading(record['value'])})
+    run(server.db.migrations.insert_one, {'_id': 'temperature_buckets.backfill', 'last_id': first})
+
+    run(server.backfill_temperature_buckets)
+    stored = bucket(run)
+    assert (stored['count'], stored['min'], stored['max']) == (4, -1, 4.5)
+    assert run(server.db.migrations.find_one, {'_id': 'temperature_buckets.backfill'})['done']
+
+def test_live_reading_does_not_skip_the_backfill(run):
+    records = [reading(number, '5') for number in range(3)]
+    run(server.db.haccp_records.insert_many, records)
+    # Logged while the backfill had not run yet
+    run(server.record_temperature, {**records[2], 'numeric_value': 5.0})
+
+    run(server.backfill_temperature_buckets)
+    assert bucket(run)['count'] == 3